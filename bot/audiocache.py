@@ -0,0 +1,179 @@
+from collections import OrderedDict
+import logging
+import os
+import struct
+import threading
+
+
+log = logging.getLogger(__name__)
+
+# Length of the Opus packet following it
+PACKET = struct.Struct('<H')
+
+
+class CacheWriter(object):
+
+    """
+    Tee of an ffmpeg player, set as both its stream and its player: the
+    PCM frames it reads are encoded into Opus once, each packet being sent
+    and appended to the cache file. Runs on the player's thread.
+    """
+
+    def __init__(self, path, player, voice):
+        self.path = path
+        self.tmp = path + '.tmp'
+        self.file = open(self.tmp, 'wb')
+        self.process = player.process
+        self.stream = player.buff
+        self.voice = voice
+        # Whether the whole track went through
+        self.complete = False
+        self._lock = threading.Lock()
+
+    def read(self, size):
+        data = self.stream.read(size)
+        if len(data) != size:
+            # The end of the track, unless ffmpeg failed on the way
+            self.complete = self.process.wait() == 0
+        return data
+
+    def play(self, pcm):
+        encoder = self.voice.encoder
+        packet = encoder.encode(pcm, encoder.samples_per_frame)
+        with self._lock:
+            if not self.file.closed:
+                self.file.write(PACKET.pack(len(packet)) + packet)
+        self.voice.play_audio(packet, encode=False)
+
+    def close(self):
+        with self._lock:
+            self.file.close()
+
+
+class CacheReader(object):
+
+    """
+    Stream of a cached file for a stream player, set as both its stream
+    and its player: each read is one Opus packet, padded to the PCM frame
+    size the player expects, which is sent without encoding it again
+    """
+
+    def __init__(self, path, voice):
+        self.file = open(path, 'rb')
+        self.voice = voice
+
+    def read(self, size):
+        header = self.file.read(PACKET.size)
+        if len(header) != PACKET.size:
+            return b''
+        (length,) = PACKET.unpack(header)
+        packet = self.file.read(length)
+        if len(packet) != length:
+            return b''
+        return (header + packet).ljust(size, b'\0')
+
+    def play(self, data):
+        (length,) = PACKET.unpack_from(data)
+        self.voice.play_audio(data[PACKET.size:PACKET.size + length], encode=False)
+
+    def close(self):
+        self.file.close()
+
+
+class AudioCache(object):
+
+    """
+    On-disk cache of the played audio, one file per video id, holding the
+    Opus packets the voice client sends (each prefixed by its length) so
+    that hits are played straight from disk, without encoding them.
+    Filled by the first play of a track, from the PCM its player decodes.
+    Files are written under a temporary name and renamed once complete,
+    the least recently played ones are removed past `max_size` bytes.
+    """
+
+    SUFFIX = '.opus'
+
+    def __init__(self, path='audio_cache', max_size=1 << 30):
+        self.path = path
+        self.max_size = max_size
+        self.size = 0
+        self._entries = OrderedDict()
+        # Video ids being written, by their first play
+        self._writing = set()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def load(self):
+        """
+        Index the files already in cache, oldest played first
+        """
+        os.makedirs(self.path, exist_ok=True)
+        files = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith(self.SUFFIX):
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name, stat.st_size))
+            else:
+                # Leftover of an interrupted play, or of the former PCM files
+                os.remove(entry.path)
+        for _, name, size in sorted(files):
+            self._entries[name[:-len(self.SUFFIX)]] = size
+            self.size += size
+        self._evict()
+        log.info('Audio cache: %d files, %d bytes', len(self._entries), self.size)
+
+    def _file(self, video_id):
+        return os.path.join(self.path, video_id + self.SUFFIX)
+
+    def get(self, video_id):
+        """
+        Path of the cached audio, None on a miss
+        """
+        if video_id not in self._entries:
+            self.stats['misses'] += 1
+            return None
+        self.stats['hits'] += 1
+        self._entries.move_to_end(video_id)
+        path = self._file(video_id)
+        # Keep the order across restarts
+        os.utime(path)
+        return path
+
+    def open(self, path, voice):
+        return CacheReader(path, voice)
+
+    def writer(self, video_id, player, voice):
+        """
+        Tee for the ffmpeg player of a miss, None if another play of the
+        track is already writing it
+        """
+        if video_id in self._entries or video_id in self._writing:
+            return None
+        self._writing.add(video_id)
+        return CacheWriter(self._file(video_id), player, voice)
+
+    def finish(self, video_id, writer):
+        """
+        Keep what the writer wrote if the whole track went through, once
+        its player is done
+        """
+        self._writing.discard(video_id)
+        writer.close()
+        size = os.path.getsize(writer.tmp)
+        if not writer.complete or size > self.max_size:
+            os.remove(writer.tmp)
+            return
+        os.replace(writer.tmp, writer.path)
+        self._entries[video_id] = size
+        self.size += size
+        self._evict()
+
+    def _evict(self):
+        while self.size > self.max_size and self._entries:
+            video_id, size = self._entries.popitem(last=False)
+            self.size -= size
+            self.stats['evictions'] += 1
+            log.debug('Evicting %s from audio cache', video_id)
+            try:
+                os.remove(self._file(video_id))
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,745 @@
+#!/usr/bin/env python
+"""
+Micro-benchmarks of the bot's building blocks, each one comparing the
+current design with the one it replaced:
+    python bench.py scheduler -n 1000000
+    python bench.py sessions -n 100000
+    python bench.py leaderboard -n 1000000
+    python bench.py messages -n 1000000
+    python bench.py music -n 100
+    python bench.py outbox -n 200
+    python bench.py logging -n 100000
+    python bench.py storage -n 100000
+"""
+import asyncio
+from datetime import datetime
+import discord
+import gc
+import logging
+import os
+import random
+import sys
+import time
+from time import monotonic
+import tracemalloc
+
+from replay import percentile
+
+
+log = logging.getLogger(__name__)
+
+
+def traced(build):
+    """
+    Run `build()`, return (its result, bytes allocated by it and still alive)
+    """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, after - before
+
+
+async def loop_lag(seconds=1, interval=0.005, until=None):
+    """
+    How late the loop wakes a task up, sampled for `seconds` or until the
+    `until` future is done
+    """
+    lags = []
+    end = monotonic() + seconds
+    while (not until.done()) if until else monotonic() < end:
+        start = monotonic()
+        await asyncio.sleep(interval)
+        lags.append(max(0.0, monotonic() - start - interval))
+    return lags
+
+
+def report(name, **values):
+    print('%-12s %s' % (name, '  '.join(
+        '%s=%s' % (key, ('%.3f' % value) if isinstance(value, float) else value)
+        for key, value in sorted(values.items()))))
+
+
+def lag_values(lags):
+    return {'lag_p99_ms': percentile(lags, 0.99) * 1000, 'lag_max_ms': max(lags) * 1000}
+
+
+# Reminder scheduling: one heap and one task vs one call_later per reminder
+
+async def bench_scheduler(n=1000000, loop=None):
+    from reminder import ReminderScheduler
+
+    now = datetime.now().timestamp()
+    rand = random.Random(0)
+    # A few of them fire while the loop lag is sampled
+    deadlines = [now + (rand.uniform(0.1, 1) if i % 100 == 0 else rand.uniform(60, 86400))
+                 for i in range(n)]
+    fired = []
+
+    def heap():
+        scheduler = ReminderScheduler(fired.extend, loop=loop)
+        for i, at_time in enumerate(deadlines):
+            scheduler.schedule('%08d' % i, '0', at_time)
+        return scheduler
+
+    def timers():
+        return dict(
+            ('%08d' % i, loop.call_later(at_time - now, fired.append, i))
+            for i, at_time in enumerate(deadlines))
+
+    for name, build in (('call_later', timers), ('heap', heap)):
+        _, memory = traced(build)
+        start = monotonic()
+        built = build()
+        scheduled = monotonic() - start
+        if name == 'heap':
+            built.start()
+        lags = await loop_lag()
+
+        start = monotonic()
+        if name == 'heap':
+            for i in range(n):
+                built.cancel('%08d' % i)
+            await built.stop()
+        else:
+            for handle in built.values():
+                handle.cancel()
+        cancelled = monotonic() - start
+        report(name, schedule_s=scheduled, cancel_s=cancelled,
+               memory_mb=memory / 1e6, **lag_values(lags))
+        del built
+
+
+# Play sessions: a plain table vs one Event and one waiting Task per player
+
+async def bench_sessions(n=100000, loop=None):
+    from gametime import Session
+
+    ended = []
+
+    async def count_task(playing, user_id, game):
+        # What TimeCounter._count_task used to do, without the db write
+        start = monotonic()
+        await playing[user_id]['event'].wait()
+        del playing[user_id]
+        ended.append((user_id, game, int(monotonic() - start)))
+
+    def tasks():
+        playing = dict()
+        for i in range(n):
+            playing[i] = {'event': asyncio.Event()}
+            playing[i]['task'] = asyncio.ensure_future(count_task(playing, i, 'game'))
+        return playing
+
+    def table():
+        return dict((i, Session('game', monotonic())) for i in range(n))
+
+    async def end(playing):
+        if isinstance(playing[0], Session):
+            for i in range(n):
+                session = playing.pop(i)
+                ended.append((i, session.game, int(monotonic() - session.start)))
+        else:
+            tasks = [p['task'] for p in playing.values()]
+            for p in list(playing.values()):
+                p['event'].set()
+            await asyncio.wait(tasks)
+
+    for name, build in (('task+event', tasks), ('session', table)):
+        playing, memory = traced(build)
+        await end(playing)
+        del ended[:]
+
+        start = monotonic()
+        playing = build()
+        started = monotonic() - start
+        # Let the tasks reach their wait()
+        await asyncio.sleep(0)
+        lags = await loop_lag()
+
+        start = monotonic()
+        await end(playing)
+        done = monotonic() - start
+        assert len(ended) == n and not playing
+        del ended[:]
+        report(name, start_s=started, end_s=done,
+               memory_mb=memory / 1e6, **lag_values(lags))
+        del playing
+
+
+# Top games and players: scanning every user vs the leaderboard index
+
+async def bench_leaderboard(n=1000000, loop=None, games=50, per_user=3):
+    from gametime import Leaderboard
+    import heapq
+    import json
+
+    rand = random.Random(0)
+    names = ['game %d' % i for i in range(games)]
+    users = dict(
+        ('%018d' % i, dict((game, rand.randint(60, 360000))
+                           for game in rand.sample(names, per_user)))
+        for i in range(n))
+    queries = 100
+
+    def scan_games():
+        totals = dict()
+        for played in users.values():
+            for game, seconds in played.items():
+                totals[game] = totals.get(game, 0) + seconds
+        return heapq.nlargest(10, totals.items(), key=lambda i: i[1])
+
+    def scan_players(game):
+        return heapq.nlargest(
+            10, ((user_id, played[game]) for user_id, played in users.items()
+                 if game in played), key=lambda i: i[1])
+
+    start = monotonic()
+    expected = scan_games(), scan_players(names[0])
+    report('scan', query_ms=(monotonic() - start) * 1000)
+
+    def rebuild():
+        leaderboard = Leaderboard()
+        leaderboard.build(
+            (user_id, game, seconds)
+            for user_id, played in users.items() for game, seconds in played.items())
+        return leaderboard
+
+    _, memory = traced(rebuild)
+    start = monotonic()
+    leaderboard = rebuild()
+    rebuilt = monotonic() - start
+    saved = json.dumps(leaderboard.dump())
+    start = monotonic()
+    Leaderboard().load(*json.loads(saved))
+    loaded = monotonic() - start
+    assert (leaderboard.games(), leaderboard.players(names[0])) == expected
+
+    start = monotonic()
+    for _ in range(queries):
+        leaderboard.games()
+        leaderboard.players(names[0])
+    queried = (monotonic() - start) / queries
+    start = monotonic()
+    for user_id in list(users)[:100000]:
+        leaderboard.add(user_id, names[0], 60, users[user_id].get(names[0], 0) + 60)
+    added = (monotonic() - start) / 100000
+
+    report('leaderboard', rebuild_s=rebuilt, load_ms=loaded * 1000,
+           query_ms=queried * 1000, add_us=added * 1e6, memory_kb=memory / 1e3,
+           saved_kb=len(saved) / 1e3)
+
+
+# Message dispatch: splitting the content twice vs parsing it once
+
+async def bench_messages(n=1000000, rounds=3, loop=None):
+    from bot import Bot
+    from replay import CONF, FakeChannel, FakeClient, FakeMessage, FakeServer, FakeUser
+
+    bot = Bot(conf=dict(CONF), client=FakeClient(loop=loop))
+    called = [0]
+
+    async def ping(message, data=None):
+        called[0] += 1
+
+    bot.add_command('ping', ping, regexp=r'^(?P<data>.+)?$')
+
+    rand = random.Random(0)
+    channels = [FakeChannel('c%d' % i, FakeServer(str(i))) for i in range(100)]
+    authors = [FakeUser(str(i)) for i in range(1000)]
+
+    def synthetic(commands):
+        return [
+            FakeMessage(('!go ping some data %d' % i) if rand.random() < commands
+                        else 'just chatting about things, %d' % i,
+                        rand.choice(authors), rand.choice(channels))
+            for i in range(n)]
+
+    # Both call the command the same way, only the parsing differs
+
+    async def split(message):
+        # What Bot.on_message and Command.call used to do
+        if not message.content.startswith(bot.conf['prefix']):
+            return
+        data = message.content.split(' ')
+        if len(data) <= 1:
+            return
+        cmd = bot.commands.get(data[1])
+        if not cmd:
+            return
+        elif cmd.admin and message.author.id != bot.conf['admin_id']:
+            return
+        data = ' '.join(message.content.split(' ')[2:])
+        await cmd._call(message, data)
+
+    async def parse(message):
+        # Bot.on_message, short of the executor
+        if not message.content.startswith(bot._prefixes):
+            return
+        cmd, data = bot.parse(message)
+        if not cmd:
+            return
+        elif cmd.admin and message.author.id != bot.admin_id:
+            return
+        await cmd._call(message, data)
+
+    paths = (('split', split), ('parse', parse), ('on_message', bot.on_message))
+    for commands in (0.1, 1):
+        messages = synthetic(commands)
+        # Best of interleaved rounds, single runs are too noisy to compare
+        best = dict()
+        for _ in range(rounds):
+            for name, dispatch in paths:
+                called[0] = 0
+                gc.collect()
+                start = monotonic()
+                for message in messages:
+                    await dispatch(message)
+                    # Let the executor's tasks run, instead of overflowing its queue
+                    while bot.executor.running > 100:
+                        await asyncio.sleep(0)
+                await bot.executor.stop(timeout=None)
+                elapsed = monotonic() - start
+                best[name] = min(best.get(name, elapsed), elapsed)
+        for name, _ in paths:
+            report(name, command_ratio=commands, commands=called[0],
+                   messages_per_s=int(n / best[name]))
+
+
+# Music: many servers playing at once against a stub voice client
+
+class StubPlayer(object):
+
+    def __init__(self, voice, after, loop):
+        self.voice = voice
+        self.after = after
+        self.loop = loop
+        self._timer = None
+
+    def start(self):
+        self.voice.playing += 1
+        self.voice.stats['playing'] += 1
+        self.voice.stats['max_playing'] = max(
+            self.voice.stats['max_playing'], self.voice.stats['playing'])
+        self._timer = self.loop.call_later(self.voice.duration, self._end)
+
+    def is_playing(self):
+        return self._timer is not None
+
+    def stop(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._end()
+
+    def _end(self):
+        self._timer = None
+        self.voice.playing -= 1
+        self.voice.stats['playing'] -= 1
+        self.after()
+
+
+class StubVoice(object):
+
+    """
+    discord.VoiceClient playing `duration` seconds long tracks
+    """
+
+    def __init__(self, client, channel, duration):
+        self.client = client
+        self.channel = channel
+        self.duration = duration
+        self.stats = client.stats
+        self.playing = 0
+        self.connected = True
+        self.played = []
+
+    def is_connected(self):
+        return self.connected
+
+    async def move_to(self, channel):
+        self.channel = channel
+
+    async def disconnect(self):
+        if self.playing:
+            self.stats['disconnected_playing'] += 1
+        if self.client.on_disconnect:
+            self.client.on_disconnect(self)
+        await asyncio.sleep(0.01)
+        self.connected = False
+        del self.client.voices[self.channel.server.id]
+
+    def create_ffmpeg_player(self, url, use_avconv=False, after=None):
+        self.played.append(url)
+        self.client.played.setdefault(self.channel.server.id, []).append(url)
+        return StubPlayer(self, after, self.client.loop)
+
+
+class StubVoiceClient(object):
+
+    def __init__(self, duration, loop):
+        self.duration = duration
+        self.loop = loop
+        self.voices = dict()
+        self.played = dict()
+        self.on_disconnect = None
+        self.stats = {'joins': 0, 'conflicts': 0, 'disconnected_playing': 0,
+                      'playing': 0, 'max_playing': 0}
+
+    async def join_voice_channel(self, channel):
+        # discord.py refuses a second connection on the same server
+        if channel.server.id in self.voices:
+            self.stats['conflicts'] += 1
+            raise discord.ClientException('Already connected to a voice channel in this server')
+        self.stats['joins'] += 1
+        voice = self.voices[channel.server.id] = StubVoice(self, channel, self.duration)
+        await asyncio.sleep(0.02)
+        return voice
+
+
+class StubResolver(object):
+
+    async def resolve(self, url):
+        await asyncio.sleep(0.01)
+        return {'url': url, 'title': url}
+
+    def prefetch(self, url):
+        pass
+
+    def close(self):
+        pass
+
+
+class StubCache(object):
+
+    def get(self, video_id):
+        return None
+
+    def writer(self, video_id, player, voice):
+        return None
+
+
+async def bench_music(n=100, loop=None, tracks=5, duration=0.2):
+    from music import MusicPlayer
+    from replay import FakeChannel, FakeServer
+
+    client = StubVoiceClient(duration, loop)
+    bot = type('Bot', (), {'client': client})()
+    music = MusicPlayer(bot, loop=loop)
+    music.resolver, music.cache = StubResolver(), StubCache()
+    channels = [FakeChannel('v%d' % i, FakeServer(str(i))) for i in range(n)]
+    expected = dict()
+
+    def queue(channel, count):
+        for _ in range(count):
+            url = 'https://www.youtube.com/watch?v=%s-%d' % (
+                channel.server.id, len(expected.setdefault(channel.server.id, [])))
+            expected[channel.server.id].append(url)
+            music.play_song(channel, url)
+
+    def late(voice):
+        # A play command coming while half of the servers disconnect
+        if voice.channel.server.id in late_servers:
+            late_servers.discard(voice.channel.server.id)
+            queue(voice.channel, 1)
+
+    late_servers = set(c.server.id for c in channels[::2])
+    client.on_disconnect = late
+
+    start = monotonic()
+    for channel in channels:
+        queue(channel, tracks)
+    lags = []
+    while music.guilds:
+        lags.extend(await loop_lag(0.1))
+    elapsed = monotonic() - start
+
+    # Songs played in order on each server, none lost
+    mismatches = sum(1 for server_id, urls in expected.items()
+                     if client.played.get(server_id) != urls)
+    report('music', servers=n, elapsed_s=elapsed,
+           ideal_s=(tracks + 1) * duration, joins=client.stats['joins'],
+           max_playing=client.stats['max_playing'],
+           conflicts=client.stats['conflicts'],
+           disconnected_playing=client.stats['disconnected_playing'],
+           mismatches=mismatches, **lag_values(lags))
+    return bool(mismatches or client.stats['conflicts'])
+
+
+# Outbox: retries, coalescing and futures against 429 and 5xx answers
+
+class StubResponse(object):
+
+    REASONS = {403: 'Forbidden', 429: 'Too Many Requests',
+               500: 'Internal Server Error', 502: 'Bad Gateway'}
+
+    def __init__(self, status):
+        self.status = status
+        self.reason = self.REASONS[status]
+
+
+class FlakyClient(object):
+
+    """
+    discord.Client answering each destination's sends from a list of
+    statuses, 200 once it runs out. 429s come with a retry_after.
+    """
+
+    def __init__(self, statuses, retry_after):
+        self.statuses = statuses
+        self.retry_after = retry_after
+        # {destination id: [(time, status, content)]}
+        self.attempts = dict()
+
+    async def send_message(self, destination, content):
+        from replay import FakeMessage
+
+        await asyncio.sleep(0.001)
+        statuses = self.statuses.get(destination.id)
+        status = statuses.pop(0) if statuses else 200
+        self.attempts.setdefault(destination.id, []).append(
+            (monotonic(), status, content))
+        if status != 200:
+            exc = discord.HTTPException(StubResponse(status), 'stub')
+            if status == 429:
+                exc.retry_after = self.retry_after
+            raise exc
+        return FakeMessage(content, None, destination)
+
+
+async def bench_outbox(n=200, loop=None, retry_after=0.05, backoff=0.02):
+    from outbox import Outbox
+    from replay import FakeChannel
+
+    # Each destination gets: nothing wrong, two 429s, two 5xx, or a 403
+    # which is not retried
+    scripts = ([], [429, 429], [500, 502], [403])
+    channels = [FakeChannel('c%d' % i) for i in range(n)]
+    client = FlakyClient(
+        dict((c.id, list(scripts[i % 4])) for i, c in enumerate(channels)),
+        retry_after)
+    outbox = Outbox(client, rate=1000, burst=1000, retries=3, backoff=backoff, loop=loop)
+
+    # Queued at once: the short ones are merged, the long one goes alone
+    futures = dict()
+    for channel in channels:
+        contents = ['%s short %d' % (channel.id, i) for i in range(2)]
+        contents.append(channel.id.ljust(1990, '.'))
+        contents += ['%s short %d' % (channel.id, i) for i in range(2, 4)]
+        futures[channel.id] = [(c, outbox.send(channel, c)) for c in contents]
+    start = monotonic()
+    # The 403s are expected
+    outbox_log = logging.getLogger('outbox')
+    level = outbox_log.level
+    outbox_log.setLevel(logging.CRITICAL)
+    try:
+        await asyncio.gather(*[f for sent in futures.values() for _, f in sent],
+                             return_exceptions=True)
+    finally:
+        outbox_log.setLevel(level)
+    elapsed = monotonic() - start
+
+    errors = []
+    for i, channel in enumerate(channels):
+        sent = futures[channel.id]
+        batches = ['\n'.join(c for c, _ in sent[:2]), sent[2][0],
+                   '\n'.join(c for c, _ in sent[3:])]
+        attempts = client.attempts[channel.id]
+        delivered = [content for _, status, content in attempts if status == 200]
+        if delivered != (batches[1:] if scripts[i % 4] == [403] else batches):
+            errors.append('%s: delivered %d batches out of order' % (
+                channel.id, len(delivered)))
+        # Each retry waited at least retry_after, and the exponential backoff
+        for attempt, (previous, current) in enumerate(zip(attempts, attempts[1:])):
+            if previous[2] != current[2]:
+                break
+            wait = max(retry_after if previous[1] == 429 else 0,
+                       backoff * 2 ** attempt)
+            if current[0] - previous[0] < wait:
+                errors.append('%s: retried after %.3fs instead of %.3fs' % (
+                    channel.id, current[0] - previous[0], wait))
+        for content, future in sent:
+            batch = next(b for b in batches if content in b.split('\n'))
+            if scripts[i % 4] == [403] and batch == batches[0]:
+                exc = future.exception()
+                if not isinstance(exc, discord.HTTPException) or exc.response.status != 403:
+                    errors.append('%s: %r instead of the 403' % (channel.id, exc))
+            elif future.exception() is not None or future.result().content != batch:
+                errors.append('%s: wrong result for %r' % (channel.id, content[:20]))
+
+    for error in errors[:10]:
+        log.error(error)
+    report('outbox', destinations=n, elapsed_s=elapsed, **dict(
+        (name, outbox.stats[name])
+        for name in ('queued', 'sent', 'coalesced', 'retries', 'failed')),
+        errors=len(errors))
+    expected = {'sent': n * 3 - n // 4, 'coalesced': n * 2,
+                'retries': (n + 2) // 4 * 2 + (n + 1) // 4 * 2, 'failed': n // 4}
+    for name, value in expected.items():
+        if outbox.stats[name] != value:
+            errors.append('%d %s instead of %d' % (outbox.stats[name], name, value))
+            log.error(errors[-1])
+    return bool(errors)
+
+
+# Logging: file handler on the loop thread vs queued to a listener thread
+
+class StallingStream(object):
+
+    """
+    A file taking `stall` seconds to flush, as a busy or network disk does
+    """
+
+    def __init__(self, stream, stall):
+        self.stream = stream
+        self.stall = stall
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    def flush(self):
+        self.stream.flush()
+        time.sleep(self.stall)
+
+
+async def bench_logging(n=100000, loop=None, stall=0.0002):
+    from bot import Bot
+    import copy
+    import logging.config
+    import log as log_conf
+    from replay import CONF, FakeChannel, FakeClient, FakeMessage, FakeServer, FakeUser
+    import shutil
+    import tempfile
+
+    bot = Bot(conf=dict(CONF), client=FakeClient(loop=loop))
+
+    async def ping(message, data=None):
+        log.info('Pong %s', data)
+
+    bot.add_command('ping', ping, regexp=r'^(?P<data>.+)?$')
+    channels = [FakeChannel('c%d' % i, FakeServer(str(i))) for i in range(100)]
+    authors = [FakeUser(str(i)) for i in range(1000)]
+    messages = [
+        FakeMessage('!go ping some data %d' % i, authors[i % 1000], channels[i % 100])
+        for i in range(n)]
+
+    async def flood(messages):
+        for message in messages:
+            await bot.on_message(message)
+            while bot.executor.running > 100:
+                await asyncio.sleep(0)
+        await bot.executor.stop(timeout=None)
+
+    workdir = tempfile.mkdtemp(prefix='bench-')
+    root = logging.getLogger()
+    try:
+        # A stalling disk writes a lot less, so gets less messages
+        for disk, count in (('local', n), ('stalling', n // 10)):
+            for name in ('direct', 'queued'):
+                filename = '%s/%s-%s.log' % (workdir, name, disk)
+                if name == 'direct':
+                    conf = copy.deepcopy(log_conf.LOGGING_CONF)
+                    conf['root']['handlers'] = ['logfile']
+                    conf['handlers']['logfile']['filename'] = filename
+                    logging.config.dictConfig(conf)
+                    listener = None
+                    handler = root.handlers[0]
+                else:
+                    listener = log_conf.setup_logging(logfile=True, filename=filename)
+                    handler = listener.handlers[0]
+                if disk == 'stalling':
+                    handler.stream = StallingStream(handler.stream, stall)
+
+                gc.collect()
+                start = monotonic()
+                task = asyncio.ensure_future(flood(messages[:count]), loop=loop)
+                lags = await loop_lag(until=task)
+                await task
+                elapsed = monotonic() - start
+                if listener:
+                    listener.stop()
+                    listener.handlers[0].close()
+                for handler in root.handlers[:]:
+                    root.removeHandler(handler)
+                    handler.close()
+                report('%s/%s' % (name, disk), messages_per_s=int(count / elapsed),
+                       **lag_values(lags))
+    finally:
+        shutil.rmtree(workdir)
+
+
+# Storage: yolodb vs sqlite under gametime-like flushes
+
+async def bench_storage(n=100000, loop=None, rounds=100, batch=1000):
+    from storage import BACKENDS, open_store
+    import shutil
+    import tempfile
+
+    rand = random.Random(0)
+    keys = ['%018d' % i for i in range(n)]
+    workdir = tempfile.mkdtemp(prefix='bench-')
+    try:
+        for backend in sorted(BACKENDS):
+            path = os.path.join(workdir, 'gametime.db')
+            db = await open_store(path, backend, loop=loop)
+            with db.batch():
+                for key in keys:
+                    db[key] = {'game %d' % i: rand.randint(60, 3600) for i in range(3)}
+            await db.close()
+
+            start = monotonic()
+            db = await open_store(path, backend, loop=loop)
+            opened = monotonic() - start
+
+            async def flushes():
+                # What TimeCounter.flush does every flush_interval
+                for _ in range(rounds):
+                    start = monotonic()
+                    with db.batch():
+                        for key in rand.sample(keys, batch):
+                            db.incr(key, 'game 0', 60)
+                    batches.append(monotonic() - start)
+                    await asyncio.sleep(0.01)
+                await db.close()
+
+            batches = []
+            start = monotonic()
+            task = asyncio.ensure_future(flushes(), loop=loop)
+            lags = await loop_lag(until=task)
+            await task
+            elapsed = monotonic() - start
+            latency = getattr(db, 'latency', None)
+            report(backend, open_s=opened, rows_per_s=int(rounds * batch / elapsed),
+                   batch_p99_ms=percentile(batches, 0.99) * 1000,
+                   write_p99_ms=latency.quantile(0.99) * 1000 if latency else '-',
+                   **lag_values(lags))
+    finally:
+        shutil.rmtree(workdir)
+
+
+BENCHMARKS = {
+    'leaderboard': bench_leaderboard,
+    'logging': bench_logging,
+    'messages': bench_messages,
+    'music': bench_music,
+    'outbox': bench_outbox,
+    'storage': bench_storage,
+    'scheduler': bench_scheduler,
+    'sessions': bench_sessions,
+}
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='Micro-benchmarks')
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('-n', type=int, help="Size of the benchmark, as above if not given")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    loop = asyncio.get_event_loop()
+    kwargs = {'n': args.n} if args.n else {}
+    # The ones checking their results return whether they failed
+    failed = loop.run_until_complete(BENCHMARKS[args.benchmark](loop=loop, **kwargs))
+    sys.exit(1 if failed else 0)
@@ -2,28 +2,85 @@
 import asyncio
 from datetime import datetime
 import discord
+import importlib
 import json
 import logging
-import logging.config
+import os
 import re
 from signal import SIGINT, SIGTERM
-
-from gametime import TimeCounter
-from log import LOGGING_CONF
-from music import MusicPlayer
-from reminder import ReminderManager
+import sys
+from time import monotonic
+
+from executor import CommandExecutor
+from log import setup_logging
+from metrics import Histogram, Metrics
+from outbox import Outbox
+from population import Population
+from connection import Client, ConnectionSupervisor
+import shards
+from storage import open_store
 from utils import get_time_string
 
 
 log = logging.getLogger(__name__)
 loop = asyncio.get_event_loop()
 
+INVITE_REGEXP = re.compile(r'(?:https?\:\/\/)?discord\.gg\/(.+)')
+
+SHARED_STORAGE = 'Shards share their databases, which needs "storage": "sqlite" in conf.json'
+
+# Modules the bot knows about, imported only once they are loaded:
+# name: (python module, class, conf key of its options, its commands)
+# with each command as (name, admin only, help)
+MODULES = {
+    'timecounter': ('gametime', 'TimeCounter', None, (
+        ('played', False,
+         'show your game time, overall or for the last [day|week|month]'),
+        ('trend', False,
+         'show how much <game> was played on each of the last 7 days'),
+        ('add', True, ''),
+        ('top', False, 'show the most played games, or the top players of [game]'),
+        ('import', True, ''),
+        ('export', True, ''),
+    )),
+    'remindermanager': ('reminder', 'ReminderManager', 'reminders', (
+        ('reminder', False, 'remind you of something in <(w)d(x)h(y)m(z)s>'),
+        ('reminder_list', False, 'List your reminders'),
+        ('reminder_delete', False, 'Remove the given reminder by uid'),
+    )),
+    'musicplayer': ('music', 'MusicPlayer', 'music', (
+        ('play', False, '<voice channel> <youtube url>'),
+        ('skip', False, 'skip the currently playing song'),
+        ('stop', False, 'stop the currently playing song and clear the queue'),
+        ('add_user', True, ''),
+        ('remove_user', True, ''),
+    )),
+    'profiler': ('profiler', 'Profiler', None, (
+        ('profile', True, 'profile the bot for <seconds> (default 30)'),
+        ('profile_stop', True, 'stop the running profile early'),
+    )),
+}
+
+# When each module is loaded, unless set in conf.json:
+# 'eager' at start, 'ready' in the background once connected, 'lazy' on
+# the first use of one of its commands ('ready' and 'lazy' modules are
+# loaded anyway by the first use of their commands)
+DEFAULT_MODULES = {
+    'timecounter': 'eager',
+    'remindermanager': 'ready',
+    'musicplayer': 'lazy',
+    'profiler': 'lazy',
+}
+
 
 class Command(object):
 
-    def __init__(self, name, handler, admin=False, regexp=r''):
+    def __init__(self, name, handler, admin=False, regexp=r'', aliases=(),
+                 metrics=None):
         self.name = name
         self.admin = admin
+        self.aliases = tuple(aliases)
+        self.metrics = metrics
         self.regexp = re.compile(regexp) if regexp else None
         if not asyncio.iscoroutinefunction(handler):
             log.warning('A command must be a coroutine')
@@ -35,8 +92,18 @@ class Command(object):
         return '<Command {}: admin={}, regexp={}>'.format(
             self.name, self.admin, bool(self.regexp))
 
-    async def call(self, message):
-        data = ' '.join(message.content.split(' ')[2:])
+    async def call(self, message, data=''):
+        """
+        `data` is the rest of the message, after the command name
+        """
+        start = monotonic()
+        try:
+            await self._call(message, data)
+        finally:
+            if self.metrics:
+                self.metrics.observe_command(self.name, monotonic() - start)
+
+    async def _call(self, message, data):
         if self.regexp:
             log.info('Regexp required for command %s', self)
             match = self.regexp.match(data)
@@ -62,31 +129,145 @@ class Bot(object):
         "prefix": "!go",
         "scrap_invites": false,
 
+        # Optional, per server prefix overrides
+        "prefixes": {
+            "server_id": "!bot"
+        },
+
+        # Optional, other names the commands answer to
+        "aliases": {
+            "p": "played",
+            "r": "reminder"
+        },
+
         "music": {
             "avconv": false,
 
             # Optional, defaulted to 'opus'
-            "opus": "opus shared library"
+            "opus": "opus shared library",
+
+            # Optional, Opus audio cache, defaulted to 1GB in 'audio_cache'
+            "cache_dir": "audio_cache",
+            "cache_size": 1073741824
+        },
+
+        # Optional, reminder delivery attempts and backoff base (seconds)
+        "reminders": {
+            "retries": 5,
+            "backoff": 2
+        },
+
+        # Optional, reconnection backoff (seconds), up to `cap` between
+        # attempts, reset once a connection stayed up `stable` seconds
+        "reconnect": {
+            "base": 1,
+            "cap": 300,
+            "stable": 60
+        },
+
+        # Optional, command execution limits
+        "commands": {
+            "concurrency": 8,
+            "queue_size": 64,
+            "timeout": 30,
+            "user_rate": 0.5,
+            "user_burst": 5,
+            "server_rate": 5,
+            "server_burst": 20
+        },
+
+        # Optional, modules to run and when to load them, 'eager', 'ready'
+        # or 'lazy', modules left out are disabled
+        "modules": {
+            "timecounter": "eager",
+            "remindermanager": "ready",
+            "musicplayer": "lazy",
+            "profiler": "lazy"
+        },
+
+        # Optional, 'yolodb' (default) or 'sqlite', which shards need
+        "storage": "sqlite",
+
+        # Optional, serve metrics on http://127.0.0.1:9100/metrics,
+        # shard N on port 9100 + N
+        "metrics": {
+            "host": "127.0.0.1",
+            "port": 9100
         }
     }
     """
 
-    def __init__(self):
+    def __init__(self, shard_id=None, shard_count=None, conf=None, client=None):
 
-        with open('conf.json', 'r') as f:
-            self.conf = json.loads(f.read())
+        if conf is None:
+            with open('conf.json', 'r') as f:
+                conf = json.loads(f.read())
+        self.conf = conf
 
         # Main parts of the bot
-        self.client = discord.Client(loop=loop)
+        self.shard_id = shard_id
+        self.shard_count = shard_count
+        if self.sharded and self.conf.get('storage') != 'sqlite':
+            raise ValueError(SHARED_STORAGE)
+        if client is not None:
+            self.client = client
+        elif self.sharded:
+            self.client = Client(
+                loop=loop, shard_id=shard_id, shard_count=shard_count)
+        else:
+            self.client = Client(loop=loop)
+        self.connection = ConnectionSupervisor(
+            self.client, **self.conf.get('reconnect', {}), loop=loop)
+        self.outbox = Outbox(self.client, loop=loop)
+        metrics = dict(self.conf.get('metrics', {}))
+        if self.sharded and metrics.get('port'):
+            # One port per shard, following the configured one
+            metrics['port'] += shard_id
+        self.metrics = Metrics(**metrics, loop=loop)
         self.modules = dict()
+        self.module_modes = dict()
+        for name, mode in self.conf.get('modules', DEFAULT_MODULES).items():
+            if name not in MODULES:
+                log.error('Unknown module %s, ignored', name)
+                continue
+            self.module_modes[name] = mode
+        self._loading = dict()
+        # Databases opened by the modules, {filename: Store}
+        self.stores = dict()
+        self.population = Population()
 
-        # Store commands
+        # Store commands, and every name or alias they answer to
         self.commands = dict()
+        self._dispatch = dict()
+
+        self.prefix = self.conf['prefix']
+        self.prefixes = self.conf.get('prefixes', {})
+        # Every prefix at once, checked first by on_message
+        self._prefixes = tuple(set([self.prefix] + list(self.prefixes.values())))
+        self.scrap_invites = self.conf.get('scrap_invites', False)
+        # {command: aliases} from the conf's {alias: command}
+        self.aliases = dict()
+        for alias, name in self.conf.get('aliases', {}).items():
+            self.aliases.setdefault(name, []).append(alias)
+        self.admin_id = self.conf['admin_id']
+        self.executor = CommandExecutor(**self.conf.get('commands', {}), loop=loop)
+
+        self.metrics.add_gauge('commands_running', lambda: self.executor.running)
+        self.metrics.add_gauge('outbox_pending', lambda: self.outbox.pending)
+        self.metrics.add_gauge('servers', lambda: len(self.population.servers))
+        self.metrics.add_gauge('users', lambda: len(self.population.users))
+        self.metrics.add_gauge(
+            'gateway_drops', lambda: self.connection.stats['drops'])
 
         # Websocket handlers
         self.client.event(self.on_member_update)
         self.client.event(self.on_ready)
         self.client.event(self.on_message)
+        self.client.event(self.on_member_join)
+        self.client.event(self.on_member_remove)
+        self.client.event(self.on_server_join)
+        self.client.event(self.on_server_remove)
+        self.client.event(self.on_server_available)
 
         self.add_command('stats', self._stats)
         self.add_command('help', self._help)
@@ -97,29 +278,94 @@ class Bot(object):
 
         self._start_time = datetime.now()
         self._commands = 0
+        self._publisher = None
+        # Users of every shard, when sharded, published once ready
+        self.members = None
+        self._ready = False
 
-    def __getattribute__(self, name):
+    def __getattr__(self, name):
         """
-        getattr or take it from the modules dict
+        Only called for missing attributes: take it from the modules dict
         """
         try:
-            return super().__getattribute__(name)
-        except AttributeError as exc:
-            try:
-                return self.modules[name]
-            except KeyError:
-                raise exc
+            return self.__dict__['modules'][name]
+        except KeyError:
+            raise AttributeError(name)
 
-    def add_command(self, *args, **kwargs):
-        cmd = Command(*args, **kwargs)
+    @property
+    def sharded(self):
+        return self.shard_count is not None
+
+    def db_path(self, filename):
+        """
+        File of this process' own state (snapshots, history), one per
+        shard when sharded, unlike the databases which they all share
+        """
+        if not self.sharded:
+            return filename
+        name, ext = os.path.splitext(filename)
+        return '%s-%d%s' % (name, self.shard_id, ext)
+
+    async def open_db(self, filename):
+        """
+        Open one of the modules' databases with the configured backend
+        """
+        store = await open_store(
+            filename, self.conf.get('storage', 'yolodb'), loop=loop)
+        self.stores[filename] = store
+        if getattr(store, 'latency', None) is not None:
+            self.metrics.add_histogram(
+                'storage_write_seconds', 'db="%s"' % filename, store.latency)
+        return store
+
+    def add_command(self, name, *args, **kwargs):
+        kwargs.setdefault('metrics', self.metrics)
+        kwargs['aliases'] = tuple(kwargs.get('aliases', ())) + tuple(
+            self.aliases.get(name, ()))
+        cmd = Command(name, *args, **kwargs)
         self.commands[cmd.name] = cmd
+        self._dispatch[cmd.name] = cmd
+        for alias in cmd.aliases:
+            self._dispatch[alias] = cmd
         log.info('Added command %s', cmd)
 
     def remove_command(self, name):
         try:
-            del self.commands[name]
+            cmd = self.commands.pop(name)
         except KeyError:
             log.error('No such command: %s', name)
+            return
+        for key in (cmd.name,) + cmd.aliases:
+            if self._dispatch.get(key) is cmd:
+                del self._dispatch[key]
+
+    def send_message(self, destination, content):
+        """
+        Queue a message through the outbox, return an awaitable future
+        """
+        return self.outbox.send(destination, content)
+
+    def get_prefix(self, message):
+        if message.server is None:
+            return self.prefix
+        return self.prefixes.get(message.server.id, self.prefix)
+
+    def parse(self, message):
+        """
+        Split a message once into its command and the command's data.
+        Return (None, None) if the message is not a command.
+        """
+        content = message.content
+        if not content.startswith(self._prefixes):
+            return None, None
+        prefix = self.prefix
+        if self.prefixes and message.server is not None:
+            prefix = self.prefixes.get(message.server.id, prefix)
+        head, _, rest = content.partition(' ')
+        if head != prefix:
+            return None, None
+        name, _, data = rest.partition(' ')
+        return self._dispatch.get(name), data
 
     async def _add_module(self, cls, *args, **kwargs):
         module = cls(*args, **kwargs)
@@ -132,6 +378,64 @@ class Bot(object):
             self.modules[cls.__name__.lower()] = module
             log.info('Module %s successfully started', cls)
 
+    def load_module(self, name):
+        """
+        Import and start a module once, return a future of the module,
+        None if it could not start
+        """
+        if name not in self._loading:
+            self._loading[name] = asyncio.ensure_future(self._load_module(name))
+        return self._loading[name]
+
+    async def _load_module(self, name):
+        path, cls_name, conf_key, _ = MODULES[name]
+        start = monotonic()
+        try:
+            # Heavy imports (youtube_dl, numpy) are kept off the event loop
+            module = await loop.run_in_executor(None, importlib.import_module, path)
+        except ImportError as exc:
+            log.error('Module %s could not be imported: %s', name, exc)
+            return None
+        kwargs = self.conf.get(conf_key, {}) if conf_key else {}
+        await self._add_module(getattr(module, cls_name), self, **kwargs, loop=loop)
+        elapsed = monotonic() - start
+        histogram = Histogram()
+        histogram.observe(elapsed)
+        self.metrics.add_histogram('module_load_seconds', 'module="%s"' % name, histogram)
+        log.info('Module %s loaded in %.3fs', name, elapsed)
+        return self.modules.get(name)
+
+    def _add_placeholders(self, name):
+        """
+        Commands standing for a module not loaded yet, loading it on use
+        """
+        for command, admin, help in MODULES[name][3]:
+            # The real command records the latency, the load time goes to
+            # module_load_seconds
+            self.add_command(
+                command, self._placeholder(name, command, help),
+                admin=admin, regexp=r'(?s)(?P<data>.*)', metrics=None)
+
+    def _placeholder(self, name, command, help):
+        async def placeholder(message, data):
+            module = await asyncio.shield(self.load_module(name))
+            cmd = self.commands.get(command)
+            if module is None or cmd is None or cmd.handler is placeholder:
+                log.error('Module %s unavailable for %s', name, command)
+                return
+            if cmd.admin and message.author.id != self.admin_id:
+                log.warning('cmd %s requires admin', cmd)
+                return
+            await cmd.call(message, data)
+        # Listed by help like the real command
+        placeholder.__doc__ = help
+        return placeholder
+
+    async def _load_ready_modules(self):
+        for name, mode in self.module_modes.items():
+            if mode == 'ready':
+                await self.load_module(name)
+
     async def _stop_modules(self):
         """
         Stop all modules, with a timeout of 2 seconds
@@ -139,32 +443,51 @@ class Bot(object):
         tasks = []
         for module in self.modules.values():
             tasks.append(asyncio.ensure_future(module.stop()))
+        for future in self._loading.values():
+            future.cancel()
+        if not tasks:
+            return
         done, not_done = await asyncio.wait(tasks, timeout=2)
         if not_done:
             log.error('Stop tasks not done: %s', not_done)
         log.info('Modules stopped')
 
     async def start(self):
-        asyncio.ensure_future(self._add_module(TimeCounter, self, loop=loop))
-        asyncio.ensure_future(self._add_module(ReminderManager, self, loop=loop))
-        asyncio.ensure_future(self._add_module(
-            MusicPlayer, self, **self.conf['music'], loop=loop
-        ))
+        await self.metrics.start()
+        for name, mode in self.module_modes.items():
+            if mode == 'eager':
+                self.load_module(name)
+            else:
+                self._add_placeholders(name)
+        if self.sharded:
+            self.members = shards.Members(self.shard_id, loop=loop)
+            await self.members.open()
+            self._publisher = asyncio.ensure_future(self._publish_stats())
         await self.client.login(self.conf['email'], self.conf['password'])
 
         try:
-            await self.client.connect()
+            await self.connection.run()
         except discord.ClientException as exc:
             error = "Something broke, I'm out!\n"
             error += '```%s```' % str(exc)
+            # The failed connection closed the client's http session
+            self.client.reopen()
             await self.client.send_message(
-                discord.User(id=self.conf['admin_id']),
+                discord.User(id=self.admin_id),
                 error
             )
             self.stop_signal()
 
     async def stop(self):
+        self.connection.stop()
+        if self._publisher:
+            self._publisher.cancel()
+        await self.executor.stop()
         await self._stop_modules()
+        if self.members:
+            await self.members.close()
+        await self.outbox.stop()
+        await self.metrics.stop()
         await self.client.logout()
 
     def stop_signal(self):
@@ -177,125 +500,245 @@ class Bot(object):
 
         f.add_done_callback(end)
 
+    def _counters(self):
+        """
+        Counters of this process, summed across shards by _stats
+        """
+        counters = self.population.counts()
+        counters['commands'] = self._commands
+        counters['playing'] = (
+            len(self.timecounter.playing) if 'timecounter' in self.modules else 0)
+        return counters
+
+    async def _publish_stats(self, interval=30):
+        while True:
+            try:
+                shards.write_stats(self.shard_id, self._counters())
+                if self._ready:
+                    await self.members.publish(self.population.users)
+                    if 'timecounter' in self.modules:
+                        self.timecounter.release()
+            except Exception as exc:
+                log.error('Could not publish shard stats: %s', exc)
+            await asyncio.sleep(interval)
+
     # Websocket handlers
 
     async def on_member_update(self, old, new):
-        if not self.timecounter:
+        self.metrics.incr('presence_updates')
+        if 'timecounter' not in self.modules:
             log.debug('timecounter not initialized')
             return
-        if new.id in self.timecounter.playing and not new.game:
-            self.timecounter.done_counting(new.id)
-        elif new.id not in self.timecounter.playing and new.game:
-            self.timecounter.start_counting(new.id, new.game.name)
+        self.timecounter.presence(new.id, new.game.name if new.game else None)
 
     async def on_ready(self):
+        # Also sent again after a reconnection which could not resume, the
+        # ongoing sessions are then only reconciled with the new presences
+        self.population.reset(self.client.servers)
+        self._ready = True
+        if self.members:
+            # Before counting, for the users of lower shards to be left out
+            try:
+                await self.members.publish(self.population.users)
+            except Exception as exc:
+                log.error('Could not publish shard members: %s', exc)
+        playing = dict()
         for server in self.client.servers:
             for member in server.members:
                 if member.game:
-                    self.timecounter.start_counting(member.id, member.game.name)
+                    playing[member.id] = member.game.name
+        if 'timecounter' in self.module_modes:
+            # Still starting when eager, its sessions need these presences
+            timecounter = await self.load_module('timecounter')
+            if timecounter is not None:
+                timecounter.reconcile(playing)
         log.info('everything ready')
+        asyncio.ensure_future(self._load_ready_modules())
+
+    async def on_member_join(self, member):
+        self.population.add_member(member.server.id, member.id)
+
+    async def on_member_remove(self, member):
+        self.population.remove_member(member.server.id, member.id)
+
+    async def on_server_join(self, server):
+        self.population.add_server(server)
+
+    async def on_server_remove(self, server):
+        self.population.remove_server(server.id)
+
+    async def on_server_available(self, server):
+        self.population.add_server(server)
 
     async def on_message(self, message):
-        # If invite in private message, join server
-        if self.conf['scrap_invites']:
-            if message.channel.is_private:
-                match = re.match(
-                    r'(?:https?\:\/\/)?discord\.gg\/(.+)',
-                    message.content)
+        # Most messages are not commands, nothing else is done for those
+        if not message.content.startswith(self._prefixes):
+            # If invite in private message, join server
+            if self.scrap_invites and message.channel.is_private:
+                match = INVITE_REGEXP.match(message.content)
                 if match and match.group(1):
                     await self.client.accept_invite(match.group(1))
                     log.info('Joined server, invite %s', match.group(1))
-                    await self.client.send_message(
+                    await self.send_message(
                         message.author, 'Joined it, thanks :)')
-                    return
-
-        if not message.content.startswith(self.conf['prefix']):
-            return
-
-        data = message.content.split(' ')
-        if len(data) <= 1:
-            log.debug('no command in message')
             return
 
-        cmd = self.commands.get(data[1])
+        cmd, data = self.parse(message)
 
         if not cmd:
-            log.debug('%s not a command', data[1])
             return
-        elif cmd.admin and message.author.id != self.conf['admin_id']:
+        elif cmd.admin and message.author.id != self.admin_id:
             log.warning('cmd %s requires admin', cmd)
             return
 
         # Go on.
         log.info('Found command %s, calling it', cmd)
-        self._commands += 1
-        await cmd.call(message)
+        if self.executor.submit(cmd, message, data):
+            self._commands += 1
 
     # Commands
 
     async def _help(self, message):
         """print the help message"""
-        msg = 'Available commands, all preceded by `%s`:\n' % self.conf['prefix']
+        msg = 'Available commands, all preceded by `%s`:\n' % self.get_prefix(message)
         for command in self.commands.values():
             if command.admin:
                 continue
-            msg += '`%s' % command.name
+            msg += '`%s' % ' | '.join((command.name,) + command.aliases)
             msg += (' : %s`\n' % command.help) if command.help else '`\n'
 
-        await self.client.send_message(message.channel, msg)
+        await self.send_message(message.channel, msg)
 
     async def _info(self, message):
         """print your id"""
-        await self.client.send_message(
+        await self.send_message(
             message.channel, "Your id: `%s`" % message.author.id)
 
     async def _source(self, message):
         """show the bot's github link"""
-        await self.client.send_message(
+        await self.send_message(
             message.channel, 'https://github.com/gdraynz/discord-bot'
         )
 
     async def _stats(self, message):
         """show the bot's general stats"""
-        users = 0
-        for s in self.client.servers:
-            users += len(s.members)
+        counters = self._counters()
+        if self.sharded:
+            # Other shards' counters, as last published
+            others = shards.read_stats(self.shard_count)
+            others.pop(self.shard_id, None)
+            for other in others.values():
+                for key in counters:
+                    counters[key] += other.get(key, 0)
+            # Users on servers of several shards are counted once
+            counters['users'] = await self.members.unique()
 
         msg = 'General informations:\n'
-        msg += '`Admin             :` <@%s>\n' % self.conf['admin_id']
+        msg += '`Admin             :` <@%s>\n' % self.admin_id
         msg += '`Uptime            : %s`\n' % get_time_string((datetime.now() - self._start_time).total_seconds())
-        msg += '`Users in touch    : %s in %s servers`\n' % (users, len(self.client.servers))
-        msg += '`Commands answered : %d`\n' % self._commands
-        msg += '`Users playing     : %d`\n' % len(self.timecounter.playing)
-        await self.client.send_message(message.channel, msg)
-
-
-def main():
-    bot = Bot()
+        gateway = self.connection.stats
+        msg += '`Gateway           : %d drops (%d sessions resumed)`\n' % (
+            gateway['drops'], gateway['resumes'])
+        if self.sharded:
+            msg += '`Shards            : %d/%d up (this is #%d)`\n' % (
+                len(others) + 1, self.shard_count, self.shard_id)
+        msg += '`Users in touch    : %s in %s servers (%s members)`\n' % (
+            counters['users'], counters['servers'], counters['members'])
+        msg += '`Commands answered : %d`\n' % counters['commands']
+        msg += '`Users playing     : %d`\n' % counters['playing']
+        ex = self.executor.stats
+        msg += '`Commands running  : %d (%d timed out, %d failed)`\n' % (
+            self.executor.running, ex['timeouts'], ex['errors'])
+        msg += '`Commands dropped  : %d rate limited, %d queue full`\n' % (
+            ex['rate_limited'], ex['rejected'])
+        out = self.outbox.stats
+        msg += '`Messages sent     : %d (%d merged, %d retried, %d failed)`\n' % (
+            out['sent'], out['coalesced'], out['retries'], out['failed'])
+        if 'musicplayer' in self.modules:
+            music = self.musicplayer
+            msg += '`Songs queued      : %d in %d servers (cache %d hits, %d misses)`\n' % (
+                music.queued, len(music.guilds),
+                music.resolver.stats['hits'], music.resolver.stats['misses'])
+        if 'remindermanager' in self.modules:
+            reminders = self.remindermanager
+            msg += '`Reminders pending : %d`\n' % reminders.pending
+            msg += '`Reminders sent    : %d (%d retried, %d dead, p99 lag <= %.0fs)`\n' % (
+                reminders.delivery['delivered'], reminders.delivery['retries'],
+                reminders.delivery['dead'], reminders.lag.quantile(0.99))
+        if 'timecounter' in self.modules:
+            presences = self.timecounter.presences
+            msg += '`Presence dupes    : %.0f%% of %d dropped`\n' % (
+                presences.collapse_ratio * 100, presences.stats['seen'])
+            flush = self.timecounter.flush_stats
+            msg += '`Gametime flushes  : %d (last %d entries in %.1fms)`\n' % (
+                flush['flushes'], flush['last_size'], flush['last_latency'] * 1000)
+        writes = [(name, store.latency) for name, store in self.stores.items()
+                  if getattr(store, 'latency', None) is not None and store.latency.count]
+        if writes:
+            name, slowest = max(writes, key=lambda i: i[1].quantile(0.99))
+            msg += '`Storage writes    : p99 <= %.0fms (%s)`\n' % (
+                slowest.quantile(0.99) * 1000, name)
+        msg += self.metrics.summary()
+        await self.send_message(message.channel, msg)
+
+
+def main(shard_id=None, shard_count=None):
+    bot = Bot(shard_id, shard_count)
 
     loop.add_signal_handler(SIGINT, bot.stop_signal)
     loop.add_signal_handler(SIGTERM, bot.stop_signal)
 
-    asyncio.ensure_future(bot.start())
+    started = asyncio.ensure_future(bot.start())
+
+    def check(future):
+        # Do not stay around without a gateway connection
+        if not future.cancelled() and future.exception():
+            log.error('Could not start: %r', future.exception())
+            bot.stop_signal()
+
+    started.add_done_callback(check)
     loop.run_forever()
 
     loop.close()
+    # Non zero for the shards supervisor to restart us
+    failed = started.done() and not started.cancelled() and started.exception()
+    return 1 if failed else 0
 
 
 if __name__ == '__main__':
-    from argparse import ArgumentParser
+    from argparse import ArgumentParser, SUPPRESS
 
     parser = ArgumentParser()
     parser.add_argument('-l', '--logfile', action='store_true', help='Log file')
     parser.add_argument('-d', '--debug', action='store_true', help='Debug mode')
+    parser.add_argument('-j', '--json', action='store_true', help='JSON logs')
+    parser.add_argument('-s', '--shards', type=int, help='Run N shard processes')
+    parser.add_argument('--shard-id', type=int, help=SUPPRESS)
+    parser.add_argument('--shard-count', type=int, help=SUPPRESS)
 
     args = parser.parse_args()
 
-    if args.logfile:
-        LOGGING_CONF['root']['handlers'] = ['logfile']
-    if args.debug:
-        LOGGING_CONF['root']['level'] = 'DEBUG'
-
-    logging.config.dictConfig(LOGGING_CONF)
-
-    main()
+    filename = None
+    if args.shard_id is not None:
+        filename = 'bot-%d.log' % args.shard_id
+    listener = setup_logging(args.logfile, args.debug, args.json, filename)
+    code = 0
+    try:
+        if args.shards:
+            with open('conf.json', 'r') as f:
+                if json.loads(f.read()).get('storage') != 'sqlite':
+                    raise SystemExit(SHARED_STORAGE)
+            # Workers get the same logging options
+            argv = []
+            if args.logfile:
+                argv.append('-l')
+            if args.debug:
+                argv.append('-d')
+            if args.json:
+                argv.append('-j')
+            shards.supervise(args.shards, argv)
+        else:
+            code = main(args.shard_id, args.shard_count)
+    finally:
+        listener.stop()
+    sys.exit(code)
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+"""
+Bulk import/export of the game times, one (user_id, game, time) row per
+line, as JSON lines or CSV:
+    {"user_id": "0123456789", "game": "Dota 2", "time": 3600}
+    user_id,game,time
+    0123456789,Dota 2,3600
+
+Rows are handled in chunks, each written in a single batch, yielding to
+the event loop in between so that a live bot keeps answering.
+Imported times are added to the existing ones, as with the `add` command.
+"""
+import asyncio
+import csv
+from itertools import islice
+import json
+import logging
+import os
+
+from storage import BACKENDS, open_store
+
+
+log = logging.getLogger(__name__)
+
+FORMATS = ('jsonl', 'csv')
+CSV_HEADER = ['user_id', 'game', 'time']
+
+
+def guess_format(filename):
+    return 'csv' if filename.lower().endswith('.csv') else 'jsonl'
+
+
+def read_rows(f, fmt='jsonl'):
+    """
+    (user_id, game, time) rows from an open text file, invalid lines are
+    logged and skipped
+    """
+    if fmt == 'csv':
+        lines = csv.reader(f)
+    else:
+        lines = (line for line in f if line.strip())
+    for number, line in enumerate(lines, 1):
+        try:
+            if fmt == 'csv':
+                if line == CSV_HEADER:
+                    continue
+                user_id, game, time = line
+            else:
+                data = json.loads(line)
+                user_id, game, time = data['user_id'], data['game'], data['time']
+            yield str(user_id), game, int(time)
+        except (ValueError, KeyError, TypeError) as exc:
+            log.warning('Skipping line %d: %s', number, exc)
+
+
+def chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+async def import_rows(db, rows, chunk_size=1000, added=None):
+    """
+    Add the rows' times to a gametime store, `added(user_id, game, time,
+    total)` being called for each of them. Return the number of rows.
+    """
+    # Tells the gametime module that its saved leaderboard is stale
+    db['generation'] = db.get('generation', 0) + 1
+    count = 0
+    for chunk in chunks(rows, chunk_size):
+        with db.batch():
+            for user_id, game, time in chunk:
+                db.incr(user_id, game, time)
+                if added:
+                    added(user_id, game, time, db[user_id][game])
+        count += len(chunk)
+        await asyncio.sleep(0)
+    return count
+
+
+async def export_rows(db, f, fmt='jsonl', chunk_size=1000):
+    """
+    Write every user's game times to an open text file. Return the number
+    of rows.
+    """
+    writer = csv.writer(f) if fmt == 'csv' else None
+    if writer:
+        writer.writerow(CSV_HEADER)
+    count = 0
+    for users in chunks(list(db.all), chunk_size):
+        for user_id in users:
+            played = db.get(user_id)
+            # Skip non-user keys such as start_time
+            if not isinstance(played, dict):
+                continue
+            for game, time in played.items():
+                if writer:
+                    writer.writerow([user_id, game, time])
+                else:
+                    f.write(json.dumps(
+                        {'user_id': user_id, 'game': game, 'time': time}) + '\n')
+                count += 1
+        await asyncio.sleep(0)
+    return count
+
+
+async def run(command, path, db_path, backend='yolodb', fmt=None, loop=None):
+    """
+    Import or export a gametime db while the bot is not running
+    """
+    fmt = fmt or guess_format(path)
+    db = await open_store(db_path, backend, loop=loop)
+    try:
+        if command == 'import':
+            with open(path, 'r', newline='') as f:
+                count = await import_rows(db, read_rows(f, fmt))
+        else:
+            with open(path + '.tmp', 'w', newline='') as f:
+                count = await export_rows(db, f, fmt)
+            os.replace(path + '.tmp', path)
+    finally:
+        await db.close()
+    log.info('%sed %d rows', command.capitalize(), count)
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='Import or export game times')
+    parser.add_argument('command', choices=('import', 'export'))
+    parser.add_argument('path', help='JSON lines or CSV file')
+    parser.add_argument('-f', '--format', choices=FORMATS,
+                        help='Defaulted from the file extension')
+    parser.add_argument('--db', default='gametime.db', help='Gametime db')
+    parser.add_argument('-b', '--backend', default='yolodb', choices=sorted(BACKENDS))
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(
+        run(args.command, args.path, args.db, args.backend, args.format, loop=loop))
+    loop.close()
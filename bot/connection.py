@@ -0,0 +1,115 @@
+import aiohttp
+import asyncio
+import discord
+from discord.gateway import DiscordWebSocket, ReconnectWebSocket, ResumeWebSocket
+import logging
+import random
+from time import monotonic
+import websockets
+
+
+log = logging.getLogger(__name__)
+
+# Close codes which no reconnection will fix: authentication failed,
+# invalid shard, sharding required
+FATAL_CODES = (4004, 4010, 4011)
+
+
+class Client(discord.Client):
+
+    """
+    discord.Client able to connect again once its connection dropped,
+    resuming the gateway session when discord still knows it
+    """
+
+    @property
+    def can_resume(self):
+        return self.connection.session_id is not None
+
+    def reopen(self):
+        """
+        Undo what close() did after a dropped connection
+        """
+        if self.is_closed:
+            self._closed.clear()
+            self.http.recreate()
+
+    async def connect(self, resume=False):
+        """
+        discord.Client.connect, resuming the last session if asked to
+        """
+        self.ws = await DiscordWebSocket.from_client(self, resume=resume)
+        while not self.is_closed:
+            try:
+                await self.ws.poll_event()
+            except (ReconnectWebSocket, ResumeWebSocket) as exc:
+                log.info('Got %s', type(exc).__name__)
+                self.ws = await DiscordWebSocket.from_client(
+                    self, resume=type(exc) is ResumeWebSocket)
+            except discord.ConnectionClosed as exc:
+                await self.close()
+                if exc.code != 1000:
+                    raise
+
+
+class ConnectionSupervisor(object):
+
+    """
+    Keep the gateway connection up. A dropped connection is opened again
+    after a jittered exponential backoff, resuming the session when
+    possible: discord then replays the missed events instead of sending
+    READY and every server again, and the bot's state is kept as is.
+    """
+
+    def __init__(self, client, base=1, cap=300, stable=60, loop=None):
+        self.client = client
+        self.loop = loop or asyncio.get_event_loop()
+        self.base = base
+        self.cap = cap
+        self.stable = stable
+        self._stopping = asyncio.Event()
+        self.stats = {'connects': 0, 'drops': 0, 'resumes': 0}
+
+    def stop(self):
+        self._stopping.set()
+
+    @staticmethod
+    def retryable(exc):
+        if isinstance(exc, discord.ConnectionClosed):
+            return exc.code not in FATAL_CODES
+        return isinstance(exc, (
+            discord.GatewayNotFound, aiohttp.ClientError, asyncio.TimeoutError,
+            OSError, websockets.exceptions.InvalidHandshake,
+            websockets.exceptions.ConnectionClosed))
+
+    async def run(self):
+        """
+        Connect until the client is closed on purpose, raise the errors
+        which can not be fixed by reconnecting
+        """
+        attempt = 0
+        resume = False
+        while not self._stopping.is_set():
+            self.client.reopen()
+            self.stats['connects'] += 1
+            if resume:
+                self.stats['resumes'] += 1
+            start = monotonic()
+            try:
+                await self.client.connect(resume=resume)
+                return
+            except Exception as exc:
+                if self._stopping.is_set() or not self.retryable(exc):
+                    raise
+                self.stats['drops'] += 1
+                if monotonic() - start >= self.stable:
+                    attempt = 0
+                delay = random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+                attempt += 1
+                resume = self.client.can_resume
+                log.warning('Connection lost (%r), reconnecting in %.1fs%s',
+                            exc, delay, ' to resume' if resume else '')
+            try:
+                await asyncio.wait_for(self._stopping.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
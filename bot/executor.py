@@ -0,0 +1,141 @@
+import asyncio
+import logging
+from time import monotonic
+
+
+log = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now):
+        self.refill(now)
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class CommandExecutor(object):
+
+    """
+    Run command handlers off the websocket handler, with:
+        - at most `concurrency` handlers running at once
+        - at most `queue_size` more waiting for a slot, excess is dropped
+        - a token bucket per user and per server
+        - a timeout on every handler
+    """
+
+    # Drop idle buckets once there are that many of them
+    MAX_BUCKETS = 10000
+
+    def __init__(self, concurrency=8, queue_size=64, timeout=30,
+                 user_rate=0.5, user_burst=5,
+                 server_rate=5, server_burst=20, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.user_limit = (user_rate, user_burst)
+        self.server_limit = (server_rate, server_burst)
+
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._user_buckets = dict()
+        self._server_buckets = dict()
+        self._tasks = set()
+
+        self.stats = {
+            'accepted': 0,
+            'rate_limited': 0,
+            'rejected': 0,
+            'timeouts': 0,
+            'errors': 0,
+        }
+
+    @property
+    def running(self):
+        return len(self._tasks)
+
+    def _allowed(self, buckets, key, limit, now):
+        bucket = buckets.get(key)
+        if bucket is None:
+            if len(buckets) >= self.MAX_BUCKETS:
+                self._prune(buckets, now)
+            bucket = buckets[key] = TokenBucket(limit[0], limit[1], now)
+        return bucket.take(now)
+
+    @staticmethod
+    def _prune(buckets, now):
+        for key, bucket in list(buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.capacity:
+                del buckets[key]
+
+    def submit(self, cmd, message, data):
+        """
+        Schedule a command call, return False if it was dropped
+        """
+        now = monotonic()
+        if not self._allowed(self._user_buckets, message.author.id,
+                             self.user_limit, now):
+            log.warning('User %s rate limited', message.author.id)
+            self.stats['rate_limited'] += 1
+            return False
+        if message.server is not None and not self._allowed(
+                self._server_buckets, message.server.id,
+                self.server_limit, now):
+            log.warning('Server %s rate limited', message.server.id)
+            self.stats['rate_limited'] += 1
+            return False
+        if len(self._tasks) >= self.concurrency + self.queue_size:
+            log.warning('Command queue full, dropping %s', cmd)
+            self.stats['rejected'] += 1
+            return False
+
+        self.stats['accepted'] += 1
+        state = dict()
+        task = state['task'] = asyncio.ensure_future(
+            self._run(cmd, message, data, state), loop=self.loop)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return True
+
+    async def _run(self, cmd, message, data, state):
+        async with self._semaphore:
+            # The task cancels itself on timeout, wait_for would run the
+            # call in a second task
+            timer = self.loop.call_later(self.timeout, self._expire, state)
+            try:
+                await cmd.call(message, data)
+            except asyncio.CancelledError:
+                if not state.get('expired'):
+                    raise
+                log.error('Command %s timed out', cmd)
+                self.stats['timeouts'] += 1
+            except Exception:
+                log.exception('Command %s failed', cmd)
+                self.stats['errors'] += 1
+            finally:
+                timer.cancel()
+
+    @staticmethod
+    def _expire(state):
+        state['expired'] = True
+        state['task'].cancel()
+
+    async def stop(self, timeout=2):
+        if self._tasks:
+            await asyncio.wait(list(self._tasks), timeout=timeout)
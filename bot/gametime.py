@@ -1,98 +1,604 @@
+import aiohttp
 import asyncio
 from datetime import datetime
+import heapq
 import logging
-import yolodb
+import os
+import tempfile
+from time import monotonic
 
+import bulk
+from history import History
+import snapshot
 from utils import get_time_string
 
 
 log = logging.getLogger(__name__)
 
+PERIODS = {
+    'day': 86400,
+    'week': 7 * 86400,
+    'month': 30 * 86400,
+}
+
+
+class Session(object):
+
+    __slots__ = ('game', 'start')
+
+    def __init__(self, game, start):
+        self.game = game
+        self.start = start
+
+
+class Leaderboard(object):
+
+    """
+    Per-game totals, the top `size` games and the top `size` players of
+    each game.
+    Play times only ever grow, so bounded dicts are enough.
+    """
+
+    def __init__(self, size=10):
+        self.size = size
+        self.totals = dict()
+        self.top = dict()
+        self.top_games = dict()
+
+    def clear(self):
+        self.totals.clear()
+        self.top.clear()
+        self.top_games.clear()
+
+    def dump(self):
+        # Copies, the stores may serialize them later on
+        return [dict(self.totals), dict((g, dict(t)) for g, t in self.top.items())]
+
+    def load(self, totals, top):
+        self.totals = totals
+        self.top = top
+        self.top_games = dict(
+            heapq.nlargest(self.size, totals.items(), key=lambda i: i[1]))
+
+    def build(self, rows):
+        """
+        Build from scratch out of (user_id, game, total) rows, a player
+        appearing once per game
+        """
+        self.clear()
+        heaps = dict()
+        for user_id, game, time in rows:
+            self.totals[game] = self.totals.get(game, 0) + time
+            heap = heaps.setdefault(game, [])
+            if len(heap) < self.size:
+                heapq.heappush(heap, (time, user_id))
+            elif time > heap[0][0]:
+                heapq.heapreplace(heap, (time, user_id))
+        self.top = dict(
+            (game, dict((user_id, time) for time, user_id in heap))
+            for game, heap in heaps.items())
+        self.top_games = dict(
+            heapq.nlargest(self.size, self.totals.items(), key=lambda i: i[1]))
+
+    def add(self, user_id, game, delta, user_total):
+        """
+        Account `delta` more seconds on a game, `user_total` being the
+        player's new total on it
+        """
+        total = self.totals[game] = self.totals.get(game, 0) + delta
+        self._rank(self.top_games, game, total)
+        self._rank(self.top.setdefault(game, {}), user_id, user_total)
+
+    def _rank(self, top, key, value):
+        if key in top or len(top) < self.size:
+            top[key] = value
+            return
+        lowest = min(top, key=top.get)
+        if value > top[lowest]:
+            del top[lowest]
+            top[key] = value
+
+    def games(self):
+        return sorted(self.top_games.items(), key=lambda i: i[1], reverse=True)
+
+    def players(self, game):
+        top = self.top.get(game, {})
+        return sorted(top.items(), key=lambda i: i[1], reverse=True)
+
+
+class PresenceFilter(object):
+
+    """
+    A user sharing several servers with the bot sends one presence update
+    per server for a single game change.
+    Only let through updates changing the user's game, identical ones
+    within `window` seconds being dropped.
+    """
+
+    def __init__(self, window=5):
+        self.window = window
+        self.last = dict()
+        self.stats = {'seen': 0, 'forwarded': 0}
+
+    @property
+    def collapse_ratio(self):
+        if not self.stats['seen']:
+            return 0.0
+        return 1 - self.stats['forwarded'] / self.stats['seen']
+
+    def changed(self, user_id, game_name):
+        now = monotonic()
+        self.stats['seen'] += 1
+        last = self.last.get(user_id)
+        if last is not None and last[0] == game_name and now - last[1] < self.window:
+            return False
+        self.last[user_id] = (game_name, now)
+        self.stats['forwarded'] += 1
+        return True
+
+    def prune(self):
+        """
+        Forget about users whose last update is out of the window
+        """
+        limit = monotonic() - self.window
+        for user_id, (_, time) in list(self.last.items()):
+            if time < limit:
+                del self.last[user_id]
+
 
 class TimeCounter(object):
 
-    def __init__(self, bot, loop=None):
+    def __init__(self, bot, flush_interval=30, flush_size=1000, loop=None):
         self.bot = bot
         self.loop = loop or asyncio.get_event_loop()
         self.db = None
         self.playing = dict()
+        self.presences = PresenceFilter()
+        self.leaderboard = Leaderboard()
+        self.history = None
+
+        # Sessions found in the last snapshot, until reconciled with the
+        # presences of on_ready, {user_id: (game, start unix time)}
+        self.restored = dict()
+        self.restored_at = None
+        # Sessions started or ended since the last save, appended to the
+        # snapshot's journal, {user_id: Session or None}
+        self._changes = dict()
+        # Size of the journal, None until a full snapshot was written
+        self._journal_size = None
+        self._snapshot_size = 0
+        self._full_snapshot = False
+
+        # Write-behind buffer, {user_id: {game: seconds}}
+        self.pending = dict()
+        self.pending_count = 0
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self._flush_task = None
+        # Running import or export, outside of the commands' timeout
+        self._bulk_task = None
+        self.flush_stats = {
+            'flushes': 0,
+            'entries': 0,
+            'last_size': 0,
+            'last_latency': 0.0,
+            'max_latency': 0.0,
+        }
 
     async def start(self):
-        self.db = await yolodb.load('gametime.db', loop=self.loop)
+        self.db = await self.bot.open_db('gametime.db')
         if not self.db.get('start_time'):
             self.db['start_time'] = int(datetime.now().timestamp())
+        if self.bot.sharded:
+            # The other shards' times change the totals all along
+            self.rebuild_leaderboard()
+        else:
+            self.load_leaderboard()
+        self.history = History(self.bot.db_path('history'), loop=self.loop)
+        self.history.load()
+        self.restored_at, self.restored = snapshot.load_sessions(self.snapshot_path)
+        if self.restored:
+            log.info('%d sessions restored from the snapshot', len(self.restored))
+        self._flush_task = asyncio.ensure_future(
+            self._flush_periodically(), loop=self.loop)
+
+        self.bot.metrics.add_gauge('gametime_sessions', lambda: len(self.playing))
+        self.bot.metrics.add_gauge('gametime_pending', lambda: self.pending_count)
+        self.bot.metrics.add_gauge(
+            'presence_collapse_ratio', lambda: self.presences.collapse_ratio)
 
-        self.bot.add_command('played', self._played_command)
+        self.bot.add_command(
+            'played', self._played_command,
+            regexp=r'^(?P<period>day|week|month)?$')
+        self.bot.add_command('trend', self._trend_command, regexp=r'^(?P<game>.+)$')
         self.bot.add_command(
             'add', self._add_command,
             admin=True,
             regexp=r'^(?P<user_id>\d+) (?P<game>.+) (?P<time>\d+)')
+        self.bot.add_command('top', self._top_command, regexp=r'^(?P<game>.+)?$')
+        self.bot.add_command(
+            'export', self._export_command,
+            admin=True, regexp=r'^(?P<fmt>jsonl|csv)?$')
+        self.bot.add_command('import', self._import_command, admin=True)
 
     async def stop(self):
+        if self._flush_task:
+            self._flush_task.cancel()
+        if self._bulk_task:
+            # Chunks already imported stay, the leaderboard is rebuilt anyway
+            self._bulk_task.cancel()
+            await asyncio.wait([self._bulk_task])
+        # Ongoing sessions are carried over to the next start, the ones
+        # never reconciled are closed at the time they were saved
+        self._close_restored(set(self.restored))
+        self.save_snapshot(full=True)
+        self.flush()
+        if not self.bot.sharded:
+            self.save_leaderboard()
+        self.history.flush()
+        await self.history.close()
         await self.db.close()
-        if self.playing:
-            tasks = [p['task'] for p in self.playing.values()]
-            for p in self.playing.values():
-                p['event'].set()
-            await asyncio.wait(tasks, timeout=2)
         self.bot.remove_command('played')
+        self.bot.remove_command('trend')
         self.bot.remove_command('add')
+        self.bot.remove_command('top')
+        self.bot.remove_command('export')
+        self.bot.remove_command('import')
+        self.bot.metrics.remove_gauge('gametime_sessions')
+        self.bot.metrics.remove_gauge('gametime_pending')
+        self.bot.metrics.remove_gauge('presence_collapse_ratio')
+
+    @property
+    def snapshot_path(self):
+        return self.bot.db_path('sessions.snapshot')
 
     @property
     def starttime(self):
         return int(datetime.now().timestamp()) - self.db.get('start_time')
 
-    async def _played_command(self, message):
-        """show your game time"""
+    async def _query(self, name, *args):
+        """
+        Run a HistoryView query on the executor
+        """
+        view = self.history.view()
+        future = self.loop.run_in_executor(None, getattr(view, name), *args)
+        # Released once the worker is done with it, even if we time out
+        future.add_done_callback(lambda _: self.history.release(view))
+        return await asyncio.shield(future)
+
+    async def _played_command(self, message, period=None):
+        """show your game time, overall or for the last [day|week|month]"""
         msg = ''
-        played = self.get(message.author.id)
+        if period:
+            since = datetime.now().timestamp() - PERIODS[period]
+            played = await self._query('played', message.author.id, since)
+        else:
+            played = self.get(message.author.id)
 
         if played:
-            msg += "As far as i'm aware, you played:\n"
+            if period:
+                msg += "As far as i'm aware, over the last %s you played:\n" % period
+            else:
+                msg += "As far as i'm aware, you played:\n"
             for game, time in played.items():
                 msg += '`%s : %s`\n' % (game, get_time_string(time))
         else:
             msg = "I don't remember you playing anything :("
 
-        await self.bot.client.send_message(message.channel, msg)
+        await self.bot.send_message(message.channel, msg)
+
+    async def _trend_command(self, message, game):
+        """show how much <game> was played on each of the last 7 days"""
+        days = 7
+        since = (int(datetime.now().timestamp()) // 86400 - days + 1) * 86400
+        trend = await self._query('trend', game, since)
+        if not any(trend):
+            msg = "Nobody played %s lately as far as i'm aware" % game
+        else:
+            trend += [0] * (days - len(trend))
+            msg = '%s over the last %d days:\n' % (game, days)
+            for day, total in enumerate(trend):
+                date = datetime.utcfromtimestamp(since + day * 86400)
+                msg += '`%s : %s`\n' % (date.strftime('%a %d'), get_time_string(total))
+
+        await self.bot.send_message(message.channel, msg)
 
     async def _add_command(self, message, user_id, game, time):
-        time = int(time)
+        self.put(user_id, game, int(time))
+        await self.bot.send_message(message.channel, "done :)")
 
-        old_time = self.get(user_id).get(game, 0)
-        self.put(user_id, game, old_time + time)
+    async def _export_command(self, message, fmt=None):
+        await self._bulk(message, 'Export', self._export(message, fmt or 'jsonl'))
+
+    async def _import_command(self, message):
+        if not message.attachments:
+            await self.bot.send_message(
+                message.channel, 'Attach a .jsonl or .csv file to import')
+            return
+        await self._bulk(message, 'Import', self._import(message.attachments[0]))
+
+    async def _bulk(self, message, what, coro):
+        """
+        Run an import or export in the background, it would not fit in the
+        commands' timeout, and report to the channel once it is done
+        """
+        if self._bulk_task and not self._bulk_task.done():
+            coro.close()
+            await self.bot.send_message(
+                message.channel, 'An import or export is already running')
+            return
+        self._bulk_task = asyncio.ensure_future(
+            self._report(message, what, coro), loop=self.loop)
+        await self.bot.send_message(
+            message.channel, "%s started, I'll tell you when it's done" % what)
+
+    async def _report(self, message, what, coro):
+        start = monotonic()
+        try:
+            count = await coro
+        except Exception:
+            log.exception('%s failed', what)
+            msg = '%s failed :(' % what
+        else:
+            msg = '%s done, %d rows in %.1fs :)' % (what, count, monotonic() - start)
+        await self.bot.send_message(message.channel, msg)
 
-        await self.bot.client.send_message(message.channel, "done :)")
+    async def _export(self, message, fmt):
+        fd, path = tempfile.mkstemp(suffix='.' + fmt)
+        try:
+            with open(fd, 'w', newline='') as f:
+                count = await self.export_rows(f, fmt)
+            with open(path, 'rb') as f:
+                await self.bot.client.send_file(
+                    message.author, f, filename='gametime.' + fmt,
+                    content='%d rows exported' % count)
+        finally:
+            os.remove(path)
+        return count
+
+    async def _import(self, attachment):
+        fmt = bulk.guess_format(attachment['filename'])
+
+        # Spool it to disk rather than in memory
+        fd, path = tempfile.mkstemp(suffix='.' + fmt)
+        try:
+            with open(fd, 'wb') as f:
+                session = aiohttp.ClientSession(loop=self.loop)
+                try:
+                    async with session.get(attachment['url']) as response:
+                        while True:
+                            data = await response.content.read(1 << 16)
+                            if not data:
+                                break
+                            f.write(data)
+                finally:
+                    session.close()
+            with open(path, 'r', newline='') as f:
+                count = await self.import_rows(bulk.read_rows(f, fmt))
+        finally:
+            os.remove(path)
+        return count
+
+    async def import_rows(self, rows):
+        """
+        Add (user_id, game, time) rows to the db, by batched chunks
+        """
+        # Pending deltas go first, the leaderboard totals include them
+        self.flush()
+
+        def added(user_id, game, time, total):
+            total += self.pending.get(user_id, {}).get(game, 0)
+            self.leaderboard.add(user_id, game, time, total)
+
+        return await bulk.import_rows(self.db, rows, added=added)
+
+    async def export_rows(self, f, fmt='jsonl'):
+        self.flush()
+        return await bulk.export_rows(self.db, f, fmt)
+
+    async def _top_command(self, message, game=None):
+        """show the most played games, or the top players of [game]"""
+        if game:
+            top = self.leaderboard.players(game)
+            if not top:
+                msg = "Nobody played %s as far as i'm aware" % game
+            else:
+                msg = 'Top players of %s:\n' % game
+                for user_id, time in top:
+                    msg += '<@%s> `%s`\n' % (user_id, get_time_string(time))
+        else:
+            top = self.leaderboard.games()
+            if not top:
+                msg = "I don't remember anyone playing anything :("
+            else:
+                msg = 'Most played games:\n'
+                for game, time in top:
+                    msg += '`%s : %s`\n' % (game, get_time_string(time))
+
+        await self.bot.send_message(message.channel, msg)
 
     def get(self, user_id):
-        return self.db.get(user_id, {})
+        """
+        Persisted totals merged with the unflushed deltas
+        """
+        played = dict(self.db.get(user_id, {}))
+        for game, time in self.pending.get(user_id, {}).items():
+            played[game] = played.get(game, 0) + time
+        return played
 
     def put(self, user_id, game, time):
-        played = self.db.get(user_id, {})
-        played[game] = played.get(game, 0) + time
-        self.db[user_id] = played
+        deltas = self.pending.setdefault(user_id, {})
+        if game not in deltas:
+            deltas[game] = 0
+            self.pending_count += 1
+        deltas[game] += time
+        total = self.db.get(user_id, {}).get(game, 0) + deltas[game]
+        self.leaderboard.add(user_id, game, time, total)
+        if self.pending_count >= self.flush_size:
+            self.flush()
 
-    async def _count_task(self, user_id, game_name):
-        start = datetime.utcnow()
+    def flush(self):
+        """
+        Write every buffered delta to the db
+        """
+        if not self.pending:
+            return
+        start = monotonic()
+        pending, size = self.pending, self.pending_count
+        self.pending, self.pending_count = dict(), 0
 
-        log.debug('Waiting for %s on %s', user_id, game_name)
-        await self.playing[user_id]['event'].wait()
-        log.debug('%s done playing %s', user_id, game_name)
+        with self.db.batch():
+            # The saved leaderboard is stale until saved again by stop()
+            self.db['generation'] = self.db.get('generation', 0) + 1
+            for user_id, deltas in pending.items():
+                for game, time in deltas.items():
+                    self.db.incr(user_id, game, time)
 
-        del self.playing[user_id]
-        # Total played
-        total = (datetime.utcnow() - start).seconds
-        # Add new game time
-        self.put(user_id, game_name, total)
+        latency = monotonic() - start
+        self.flush_stats['flushes'] += 1
+        self.flush_stats['entries'] += size
+        self.flush_stats['last_size'] = size
+        self.flush_stats['last_latency'] = latency
+        self.flush_stats['max_latency'] = max(
+            latency, self.flush_stats['max_latency'])
+        log.debug('Flushed %d gametime entries in %.3fs', size, latency)
+
+    def load_leaderboard(self):
+        """
+        Load the leaderboard saved by the last stop, or rebuild it if the
+        totals changed since (e.g. a crash or an offline import)
+        """
+        saved = self.db.get('leaderboard')
+        if saved and saved[0] == self.db.get('generation', 0):
+            self.leaderboard.load(*saved[1:])
+            log.info('Leaderboard loaded for %d games', len(self.leaderboard.totals))
+        else:
+            self.rebuild_leaderboard()
+
+    def save_leaderboard(self):
+        """
+        Save the leaderboard along with the db generation it matches.
+        A list, so that it is skipped with the other non-user keys.
+        """
+        self.db['leaderboard'] = [self.db.get('generation', 0)] + self.leaderboard.dump()
+
+    def rebuild_leaderboard(self):
+        """
+        Build the leaderboard from scratch out of the persisted totals
+        """
+        self.leaderboard.build(
+            (user_id, game, time)
+            for user_id, played in self.db.all.items()
+            # Skip non-user keys such as start_time
+            if isinstance(played, dict)
+            for game, time in played.items())
+        log.info('Leaderboard built for %d games', len(self.leaderboard.totals))
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            self.flush()
+            self.history.flush()
+            self.presences.prune()
+            if self._changes or self._full_snapshot:
+                self.save_snapshot()
+
+    def save_snapshot(self, full=False):
+        """
+        Append the session changes to the snapshot's journal, or write a
+        full snapshot when asked to, on the first save or once the journal
+        outgrows the snapshot
+        """
+        now = datetime.now().timestamp()
+        elapsed = monotonic()
+        wall = lambda session: (session.game, now - (elapsed - session.start))
+        if (full or self._full_snapshot or self._journal_size is None or
+                self._journal_size > max(self._snapshot_size, 1 << 16)):
+            sessions = dict(
+                (user_id, wall(session))
+                for user_id, session in self.playing.items())
+            self._snapshot_size = snapshot.save_sessions(
+                self.snapshot_path, now, sessions)
+            self._journal_size = 0
+        else:
+            changes = dict(
+                (user_id, session and wall(session))
+                for user_id, session in self._changes.items())
+            self._journal_size = snapshot.append_sessions(
+                self.snapshot_path, now, changes)
+        self._changes.clear()
+        self._full_snapshot = False
+
+    def reconcile(self, playing):
+        """
+        Align the sessions with the presences of a fresh {user_id: game}
+        dump. Restored sessions still on the same game go on from their
+        original start, the others are closed at the snapshot time.
+        """
+        for user_id, session in list(self.playing.items()):
+            if playing.get(user_id) != session.game:
+                self.done_counting(user_id)
+
+        now = datetime.now().timestamp()
+        elapsed = monotonic()
+        for user_id, (game, start) in list(self.restored.items()):
+            if playing.get(user_id) == game:
+                del self.restored[user_id]
+                self.playing[user_id] = Session(game, elapsed - (now - start))
+        self._close_restored(list(self.restored))
+
+        for user_id, game in playing.items():
+            self.start_counting(user_id, game)
+        self._full_snapshot = True
+
+    def _close_restored(self, user_ids):
+        for user_id in user_ids:
+            game, start = self.restored.pop(user_id)
+            duration = max(0, int(self.restored_at - start))
+            self.put(user_id, game, duration)
+            self.history.append(user_id, game, start, duration)
+
+    def presence(self, user_id, game_name):
+        """
+        Account for a presence update, `game_name` being None when the
+        user is not playing anything
+        """
+        if not self.presences.changed(user_id, game_name):
+            return
+        session = self.playing.get(user_id)
+        if session is not None and session.game != game_name:
+            self.done_counting(user_id)
+        if game_name:
+            self.start_counting(user_id, game_name)
 
     def start_counting(self, user_id, game_name):
+        members = self.bot.members
+        if members is not None and not members.owns(user_id):
+            # Counted by a lower shard
+            return
         if user_id not in self.playing:
-            self.playing[user_id] = {
-                'event': asyncio.Event(),
-                'task': asyncio.ensure_future(self._count_task(user_id, game_name))
-            }
+            log.debug('Counting %s on %s', user_id, game_name)
+            session = self.playing[user_id] = Session(game_name, monotonic())
+            self._changes[user_id] = session
         # else do not take that into account. One game per user.
 
+    def release(self):
+        """
+        End the sessions of the users now counted by a lower shard, e.g.
+        one started after us
+        """
+        for user_id in list(self.playing):
+            if not self.bot.members.owns(user_id):
+                self.done_counting(user_id)
+
     def done_counting(self, user_id):
-        if user_id in self.playing:
-            self.playing[user_id]['event'].set()
+        session = self.playing.pop(user_id, None)
+        if session is None:
+            return
+        log.debug('%s done playing %s', user_id, session.game)
+        self._changes[user_id] = None
+        duration = int(monotonic() - session.start)
+        # Add new game time
+        self.put(user_id, session.game, duration)
+        self.history.append(
+            user_id, session.game, datetime.now().timestamp() - duration, duration)
@@ -0,0 +1,301 @@
+from array import array
+import asyncio
+import json
+import logging
+import os
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+log = logging.getLogger(__name__)
+
+
+COLUMNS = (('user', 'Q', 'uint64'), ('game', 'I', 'uint32'),
+           ('start', 'I', 'uint32'), ('duration', 'I', 'uint32'))
+
+
+def segment_file(path, segment, column):
+    return os.path.join(path, '%06d.%s' % (segment, column))
+
+
+def read_column(path, segment, rows, column):
+    """
+    The first `rows` values of a column as an array, memory-mapped with
+    numpy
+    """
+    code, dtype = dict((n, (c, d)) for n, c, d in COLUMNS)[column]
+    path = segment_file(path, segment, column)
+    if numpy is not None:
+        if not rows:
+            return numpy.zeros(0, dtype=dtype)
+        return numpy.memmap(path, dtype=dtype, mode='r', shape=(rows,))
+    values = array(code)
+    if rows:
+        with open(path, 'rb') as f:
+            values.fromfile(f, rows)
+    return values
+
+
+def merge_segments(path, segments, merged):
+    """
+    Write the (segment, rows) segments' rows into the `merged` segment
+    """
+    for name, _, _ in COLUMNS:
+        target = segment_file(path, merged, name)
+        with open(target + '.tmp', 'wb') as out:
+            for segment, rows in segments:
+                read_column(path, segment, rows, name).tofile(out)
+        os.replace(target + '.tmp', target)
+
+
+class History(object):
+
+    """
+    Every completed game session, as (user, game, start, duration) rows
+    stored by columns of fixed width in append-only segment files:
+        <path>/<segment>.user      uint64
+        <path>/<segment>.game      uint32, index in games.json
+        <path>/<segment>.start     uint32, unix time
+        <path>/<segment>.duration  uint32, seconds
+    meta.json lists the live segments, new rows go to the active one.
+    Segments are memory-mapped and aggregated with numpy when available.
+    Writes happen on the loop thread, queries on a HistoryView taken
+    from there and safe to read from another thread.
+
+    Sealed segments are merged by tiers of similar sizes, more than
+    `compact_size` segments of a tier making one of the next, so a row is
+    rewritten a logarithmic number of times. The merge runs on the
+    executor, only meta.json is swapped on the loop thread.
+    """
+
+    def __init__(self, path='history', segment_size=1 << 20, compact_size=8,
+                 loop=None):
+        self.path = path
+        self.segment_size = segment_size
+        self.compact_size = compact_size
+        self.loop = loop or asyncio.get_event_loop()
+        self.meta = None
+        self.games = []
+        self._game_ids = dict()
+        self._buffer = self._empty()
+        self._compaction = None
+        # Views not released yet, merged segments are only removed once
+        # none is reading them
+        self._readers = 0
+        self._obsolete = []
+
+    def _empty(self):
+        return dict((name, array(code)) for name, code, _ in COLUMNS)
+
+    def _file(self, segment, column):
+        return segment_file(self.path, segment, column)
+
+    def _write_json(self, name, data):
+        path = os.path.join(self.path, name)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(data, f)
+        os.replace(path + '.tmp', path)
+
+    def load(self):
+        os.makedirs(self.path, exist_ok=True)
+        try:
+            with open(os.path.join(self.path, 'meta.json'), 'r') as f:
+                self.meta = json.load(f)
+            with open(os.path.join(self.path, 'games.json'), 'r') as f:
+                self.games = json.load(f)
+        except FileNotFoundError:
+            self.meta = {'segments': [0], 'active': 0, 'next': 1}
+            self._write_json('meta.json', self.meta)
+            self._write_json('games.json', self.games)
+        self._game_ids = dict((game, i) for i, game in enumerate(self.games))
+
+    def append(self, user_id, game, start, duration):
+        game_id = self._game_ids.get(game)
+        if game_id is None:
+            game_id = self._game_ids[game] = len(self.games)
+            self.games.append(game)
+            self._write_json('games.json', self.games)
+        self._buffer['user'].append(int(user_id))
+        self._buffer['game'].append(game_id)
+        self._buffer['start'].append(int(start))
+        self._buffer['duration'].append(int(duration))
+
+    def _rows(self, segment):
+        # Columns may differ after a crash mid-append, trust the shortest
+        return min(
+            os.path.getsize(self._file(segment, name)) // array(code).itemsize
+            if os.path.exists(self._file(segment, name)) else 0
+            for name, code, _ in COLUMNS)
+
+    def flush(self):
+        """
+        Append the buffered rows to the active segment
+        """
+        if self._buffer['user']:
+            active = self.meta['active']
+            for name, _, _ in COLUMNS:
+                with open(self._file(active, name), 'ab') as f:
+                    self._buffer[name].tofile(f)
+            self._buffer = self._empty()
+
+            if self._rows(active) >= self.segment_size:
+                self.meta['active'] = self.meta['next']
+                self.meta['segments'].append(self.meta['next'])
+                self.meta['next'] += 1
+                self._write_json('meta.json', self.meta)
+        self.compact()
+
+    def _tier(self, rows):
+        tier, size = 0, self.segment_size * self.compact_size
+        while rows >= size:
+            tier += 1
+            size *= self.compact_size
+        return tier
+
+    def compact(self):
+        """
+        Start merging the lowest tier holding more than `compact_size`
+        sealed segments, one merge at a time
+        """
+        if self._compaction is not None:
+            return
+        tiers = dict()
+        for segment in self.meta['segments']:
+            if segment != self.meta['active']:
+                rows = self._rows(segment)
+                tiers.setdefault(self._tier(rows), []).append((segment, rows))
+        full = [tier for tier, segments in tiers.items()
+                if len(segments) > self.compact_size]
+        if not full:
+            return
+        segments = tuple(tiers[min(full)])
+        merged = self.meta['next']
+        # Saved with the next roll or the merge, whichever comes first
+        self.meta['next'] += 1
+        self._compaction = self.loop.run_in_executor(
+            None, merge_segments, self.path, segments, merged)
+        self._compaction.add_done_callback(
+            lambda future: self._compacted(future, segments, merged))
+
+    def _compacted(self, future, segments, merged):
+        self._compaction = None
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            log.error('Could not compact the history: %s', future.exception())
+            return
+        done = set(segment for segment, _ in segments)
+        self.meta['segments'] = [
+            s for s in self.meta['segments'] if s not in done] + [merged]
+        self._write_json('meta.json', self.meta)
+        self._obsolete.extend(done)
+        self._remove_obsolete()
+        log.info('Compacted %d history segments', len(segments))
+        # The merged segment may fill its own tier
+        self.compact()
+
+    def _remove_obsolete(self):
+        if self._readers:
+            return
+        for segment in self._obsolete:
+            for name, _, _ in COLUMNS:
+                os.remove(self._file(segment, name))
+        self._obsolete = []
+
+    async def close(self):
+        """
+        Wait for a running compaction
+        """
+        while self._compaction is not None:
+            await asyncio.wait([self._compaction])
+            # Let its done callback run
+            await asyncio.sleep(0)
+
+    def view(self):
+        """
+        Flush, then return what is stored now for another thread to
+        query. Must be released once done with it, its segments are kept
+        until then.
+        """
+        self.flush()
+        self._readers += 1
+        segments = tuple(
+            (segment, self._rows(segment)) for segment in self.meta['segments'])
+        return HistoryView(self.path, segments, tuple(self.games))
+
+    def release(self, view):
+        self._readers -= 1
+        self._remove_obsolete()
+
+
+class HistoryView(object):
+
+    """
+    The history as it was when the view was taken: the segments with
+    their number of rows, and the game names. Rows appended since are
+    ignored, and the segments are not removed until it is released.
+    """
+
+    def __init__(self, path, segments, games):
+        self.path = path
+        self.segments = segments
+        self.games = games
+
+    def _segments(self):
+        for segment, rows in self.segments:
+            yield dict((name, read_column(self.path, segment, rows, name))
+                       for name, _, _ in COLUMNS)
+
+    def played(self, user_id, since=0):
+        """
+        {game: seconds} played by a user since the given unix time
+        """
+        user_id = int(user_id)
+        totals = dict()
+        for columns in self._segments():
+            if numpy is not None:
+                mask = (columns['user'] == user_id) & (columns['start'] >= since)
+                sums = numpy.bincount(
+                    columns['game'][mask], weights=columns['duration'][mask])
+                for game_id in numpy.nonzero(sums)[0]:
+                    game = self.games[game_id]
+                    totals[game] = totals.get(game, 0) + int(sums[game_id])
+            else:
+                for user, game_id, start, duration in zip(
+                        columns['user'], columns['game'],
+                        columns['start'], columns['duration']):
+                    if user == user_id and start >= since:
+                        game = self.games[game_id]
+                        totals[game] = totals.get(game, 0) + duration
+        return totals
+
+    def trend(self, game, since, step=86400):
+        """
+        Seconds played on a game per `step` seconds since the given time
+        """
+        if game not in self.games:
+            return []
+        game_id = self.games.index(game)
+        totals = []
+        for columns in self._segments():
+            if numpy is not None:
+                mask = (columns['game'] == game_id) & (columns['start'] >= since)
+                buckets = (columns['start'][mask] - since) // step
+                sums = numpy.bincount(buckets.astype('int64'),
+                                      weights=columns['duration'][mask])
+                sums = [int(s) for s in sums]
+            else:
+                sums = []
+                for gid, start, duration in zip(
+                        columns['game'], columns['start'], columns['duration']):
+                    if gid == game_id and start >= since:
+                        bucket = (start - since) // step
+                        sums.extend([0] * (bucket + 1 - len(sums)))
+                        sums[bucket] += duration
+            totals.extend([0] * (len(sums) - len(totals)))
+            for i, value in enumerate(sums):
+                totals[i] += value
+        return totals
@@ -1,8 +1,50 @@
+import json
+import logging
+import logging.config
+import logging.handlers
+import queue
+
+
+class JsonFormatter(logging.Formatter):
+
+    """
+    One JSON object per line
+    """
+
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            data['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(data)
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+
+    """
+    Leave the formatting to the listener thread, the stock handler does it
+    on the logging one to be able to pickle the record
+    """
+
+    def prepare(self, record):
+        # Merge the arguments now, they might change before being formatted
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
 LOGGING_CONF = {
     "version": 1,
     "formatters": {
         "long": {
             "format": "%(asctime)-24s %(levelname)-8s [%(name)s] %(message)s"
+        },
+        "json": {
+            "()": JsonFormatter
         }
     },
     "handlers": {
@@ -12,9 +54,11 @@ LOGGING_CONF = {
             "stream": "ext://sys.stdout"
         },
         "logfile": {
-            "class": "logging.FileHandler",
+            "class": "logging.handlers.RotatingFileHandler",
             "formatter": "long",
-            "filename": "bot.log"
+            "filename": "bot.log",
+            "maxBytes": 10 * 1024 * 1024,
+            "backupCount": 5
         }
     },
     "root": {
@@ -34,3 +78,40 @@ LOGGING_CONF = {
     },
     "disable_existing_loggers": False
 }
+
+
+def setup_logging(logfile=False, debug=False, json=False, filename=None):
+    """
+    Configure logging so that the event loop only ever pushes records to
+    a queue, the configured handlers being run by a listener thread.
+    Return the listener, to be stopped before exiting.
+    """
+    if logfile:
+        LOGGING_CONF['root']['handlers'] = ['logfile']
+    if filename:
+        LOGGING_CONF['handlers']['logfile']['filename'] = filename
+    if debug:
+        LOGGING_CONF['root']['level'] = 'DEBUG'
+    if json:
+        for handler in LOGGING_CONF['handlers'].values():
+            handler['formatter'] = 'json'
+
+    logging.config.dictConfig(LOGGING_CONF)
+
+    # Record fields none of the formats use, costly to fill in
+    logging._srcfile = None
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+
+    root = logging.getLogger()
+    handlers = root.handlers[:]
+    records = queue.Queue()
+    for handler in handlers:
+        root.removeHandler(handler)
+    root.addHandler(QueueHandler(records))
+
+    listener = logging.handlers.QueueListener(
+        records, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
@@ -0,0 +1,197 @@
+import asyncio
+from bisect import bisect_left
+import logging
+from time import monotonic
+
+
+log = logging.getLogger(__name__)
+
+
+def all_tasks(loop):
+    if hasattr(asyncio, 'all_tasks'):
+        return asyncio.all_tasks(loop)
+    return asyncio.Task.all_tasks(loop)
+
+
+class Histogram(object):
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket holding the q-th quantile
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def render(self, name, labels=''):
+        lines = []
+        seen = 0
+        sep = ',' if labels else ''
+        for bound, count in zip(self.BUCKETS, self.counts):
+            seen += count
+            lines.append('%s_bucket{%s%sle="%s"} %d' % (name, labels, sep, bound, seen))
+        lines.append('%s_bucket{%s%sle="+Inf"} %d' % (name, labels, sep, self.count))
+        suffix = '{%s}' % labels if labels else ''
+        lines.append('%s_sum%s %f' % (name, suffix, self.sum))
+        lines.append('%s_count%s %d' % (name, suffix, self.count))
+        return lines
+
+
+class Metrics(object):
+
+    """
+    Collect the bot's metrics and serve them, prometheus style, on
+    http://<host>:<port>/metrics when a port is given.
+        - latency histogram per command
+        - event loop lag, sampled every `interval` seconds
+        - counters, such as presence updates (and their rate)
+        - gauges, read from callbacks registered by the modules
+        - histograms kept by the modules, such as storage write latencies
+    """
+
+    def __init__(self, host='127.0.0.1', port=None, interval=1, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.host = host
+        self.port = port
+        self.interval = interval
+
+        self.commands = dict()
+        self.counters = dict()
+        self.rates = dict()
+        self.gauges = dict()
+        # {(name, labels): Histogram}
+        self.histograms = dict()
+        self.loop_lag = 0.0
+        self.loop_lag_histogram = Histogram()
+
+        self.add_gauge('asyncio_tasks', lambda: len(all_tasks(self.loop)))
+
+        self._sampler = None
+        self._server = None
+
+    async def start(self):
+        self._sampler = asyncio.ensure_future(self._sample(), loop=self.loop)
+        if self.port:
+            self._server = await asyncio.start_server(
+                self._handle, self.host, self.port)
+            log.info('Serving metrics on %s:%s', self.host, self.port)
+
+    async def stop(self):
+        if self._sampler:
+            self._sampler.cancel()
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+
+    def observe_command(self, name, seconds):
+        histogram = self.commands.get(name)
+        if histogram is None:
+            histogram = self.commands[name] = Histogram()
+        histogram.observe(seconds)
+
+    def incr(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_gauge(self, name, func):
+        self.gauges[name] = func
+
+    def remove_gauge(self, name):
+        self.gauges.pop(name, None)
+
+    def add_histogram(self, name, labels, histogram):
+        self.histograms[(name, labels)] = histogram
+
+    async def _sample(self):
+        previous = dict(self.counters)
+        while True:
+            start = monotonic()
+            await asyncio.sleep(self.interval)
+            elapsed = monotonic() - start
+            self.loop_lag = max(0.0, elapsed - self.interval)
+            self.loop_lag_histogram.observe(self.loop_lag)
+
+            for name, value in self.counters.items():
+                self.rates[name] = (value - previous.get(name, 0)) / elapsed
+            previous = dict(self.counters)
+
+    def read_gauges(self):
+        values = dict()
+        for name, func in self.gauges.items():
+            try:
+                values[name] = func()
+            except Exception as exc:
+                log.error('Gauge %s failed: %s', name, exc)
+        return values
+
+    def render(self):
+        lines = ['bot_loop_lag_seconds %f' % self.loop_lag]
+        lines += self.loop_lag_histogram.render('bot_loop_lag')
+        for name, histogram in sorted(self.commands.items()):
+            lines += histogram.render(
+                'bot_command_latency_seconds', 'command="%s"' % name)
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            lines += histogram.render('bot_%s' % name, labels)
+        for name, value in sorted(self.counters.items()):
+            lines.append('bot_%s_total %d' % (name, value))
+        for name, value in sorted(self.rates.items()):
+            lines.append('bot_%s_per_second %f' % (name, value))
+        for name, value in sorted(self.read_gauges().items()):
+            lines.append('bot_%s %s' % (name, value))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """
+        A few lines for the stats command
+        """
+        gauges = self.read_gauges()
+        msg = '`Loop lag          : %.1fms`\n' % (self.loop_lag * 1000)
+        msg += '`Pending tasks     : %d`\n' % gauges.get('asyncio_tasks', 0)
+        msg += '`Presence updates  : %.1f/s`\n' % self.rates.get('presence_updates', 0)
+        slowest = sorted(
+            self.commands.items(), key=lambda i: i[1].quantile(0.95), reverse=True)
+        for name, histogram in slowest[:3]:
+            msg += '`p95 %-14s: %.0fms`\n' % (name, histogram.quantile(0.95) * 1000)
+        return msg
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await reader.readline()
+            # Skip the headers
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1] == '/metrics':
+                status, body = '200 OK', self.render()
+            else:
+                status, body = '404 Not Found', 'not found\n'
+            body = body.encode()
+            writer.write((
+                'HTTP/1.0 %s\r\n'
+                'Content-Type: text/plain; version=0.0.4\r\n'
+                'Content-Length: %d\r\n\r\n' % (status, len(body))
+            ).encode() + body)
+            await writer.drain()
+        except Exception as exc:
+            log.error('Metrics request failed: %s', exc)
+        finally:
+            writer.close()
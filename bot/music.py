@@ -1,22 +1,161 @@
 import asyncio
+from collections import deque
 import discord
 import logging
-import yolodb
+
+from audiocache import AudioCache
+from resolver import Resolver, video_id
 
 
 log = logging.getLogger(__name__)
 
 
+class GuildPlayer(object):
+
+    """
+    Playback state of a single server: its voice connection, the current
+    player and the queue of tracks waiting to be played
+    """
+
+    def __init__(self, music, server):
+        self.music = music
+        self.server = server
+        self.loop = music.loop
+        self.queue = deque()
+        self.voice = None
+        self.player = None
+        self.ended = asyncio.Event()
+        self.task = None
+
+    @property
+    def is_running(self):
+        return self.task is not None and not self.task.done()
+
+    def enqueue(self, channel, url):
+        self.queue.append((channel, url))
+        if not self.is_running:
+            self.task = asyncio.ensure_future(self._run(), loop=self.loop)
+        elif len(self.queue) == 1:
+            self.music.resolver.prefetch(url)
+
+    async def _connect(self, channel):
+        """
+        Reuse the server's voice connection, moving it if needed
+        """
+        if self.voice is None or not self.voice.is_connected():
+            log.info('Joining voice channel %s', channel)
+            self.voice = await self.music.bot.client.join_voice_channel(channel)
+        elif self.voice.channel != channel:
+            log.info('Moving to voice channel %s', channel)
+            await self.voice.move_to(channel)
+        return self.voice
+
+    async def _run(self):
+        try:
+            while self.queue:
+                channel, url = self.queue.popleft()
+                try:
+                    await self._play_song(channel, url)
+                except Exception:
+                    log.exception('Could not play %s', url)
+        finally:
+            self.player = None
+            if self.voice is not None:
+                await self.voice.disconnect()
+                self.voice = None
+            # Forget about it once disconnected, a new player would not be
+            # able to join while this one is still connected
+            if self.music.guilds.get(self.server.id) is self:
+                del self.music.guilds[self.server.id]
+            # Songs queued while disconnecting go to a new player
+            while self.queue:
+                self.music.play_song(*self.queue.popleft())
+
+    async def _play_song(self, channel, url):
+        self.ended.clear()
+        key = video_id(url)
+        cached = self.music.cache.get(key)
+        if cached:
+            voice = await self._connect(channel)
+        else:
+            info, voice = await asyncio.gather(
+                self.music.resolver.resolve(url), self._connect(channel))
+        if self.ended.is_set():
+            log.info('Skipped before it started: %s', url)
+            return
+
+        writer = None
+        if cached:
+            log.info('Playing %s from cache', url)
+            stream = self.music.cache.open(cached, voice)
+            self.player = voice.create_stream_player(stream, after=self._after)
+            self.player.player = stream.play
+        else:
+            log.info('Playing %s from url %s', info['title'], url)
+            stream = None
+            self.player = voice.create_ffmpeg_player(
+                info['url'], use_avconv=self.music.use_avconv, after=self._after)
+            # Cached from what this player decodes, as it plays
+            writer = self.music.cache.writer(key, self.player, voice)
+            if writer is not None:
+                self.player.buff = writer
+                self.player.player = writer.play
+        self.player.start()
+        # Get the next one ready while this one plays
+        if self.queue:
+            self.music.resolver.prefetch(self.queue[0][1])
+        log.info('Waiting for it to end...')
+        try:
+            await self.ended.wait()
+        finally:
+            if self.player.is_playing():
+                self.player.stop()
+            if writer is not None:
+                # Once its thread is done writing the last packet
+                done = self.loop.run_in_executor(None, self.player.join)
+                done.add_done_callback(
+                    lambda _: self.music.cache.finish(key, writer))
+            self.player = None
+            if stream is not None:
+                stream.close()
+
+    def _after(self):
+        # Called from the player's thread
+        self.loop.call_soon_threadsafe(self.ended.set)
+
+    def resume_player(self):
+        if self.player and not self.player.is_playing():
+            log.info('Resuming paused player')
+            self.player.resume()
+
+    def pause_player(self):
+        if self.player and self.player.is_playing():
+            log.info('Pausing player')
+            self.player.pause()
+
+    def skip(self):
+        if self.player and self.player.is_playing():
+            log.info('Something playing, stopping it')
+            self.player.stop()
+            log.info('Player stopped')
+        self.ended.set()
+
+    def stop_player(self):
+        self.queue.clear()
+        self.skip()
+
+
 class MusicPlayer(object):
 
-    def __init__(self, bot, avconv=False, opus='opus', loop=None):
+    def __init__(self, bot, avconv=False, opus='opus',
+                 cache_dir='audio_cache', cache_size=1 << 30, loop=None):
         self.use_avconv = avconv
         self.opus_library = opus
         self.loop = loop or asyncio.get_event_loop()
         self.bot = bot
-        self.ended = asyncio.Event()
-        self.player = None
-        self.play_future = None
+        self.guilds = dict()
+        self.resolver = Resolver(loop=self.loop)
+        self.cache = AudioCache(cache_dir, cache_size)
         self.db = None
 
     @property
@@ -27,12 +166,17 @@ class MusicPlayer(object):
         # Load opus shared library, might fail
         discord.opus.load_opus(self.opus_library)
 
-        self.db = await yolodb.load('music.db', loop=self.loop)
+        self.db = await self.bot.open_db('music.db')
+        self.cache.load()
+
+        self.bot.metrics.add_gauge('music_queued', lambda: self.queued)
+        self.bot.metrics.add_gauge('music_servers', lambda: len(self.guilds))
 
         self.bot.add_command(
             'play', self._command_play_song,
             regexp=r'^(?P<channel>.+) '
                    r'(?P<url>https:\/\/www.youtube.com\/watch\?v=.+)')
+        self.bot.add_command('skip', self._command_skip_song)
         self.bot.add_command('stop', self._command_stop_song)
         self.bot.add_command(
             'add_user', self._command_add_user,
@@ -42,44 +186,67 @@ class MusicPlayer(object):
             admin=True, regexp=r'^(?P<user_id>\d+)')
 
     async def stop(self):
-        if self.player:
-            self.player.stop()
-        self.ended.set()
-        if self.play_future:
-            await self.play_future
+        tasks = []
+        for guild in list(self.guilds.values()):
+            guild.stop_player()
+            if guild.task:
+                tasks.append(guild.task)
+        if tasks:
+            await asyncio.wait(tasks)
+        self.resolver.close()
         await self.db.close()
+        self.bot.metrics.remove_gauge('music_queued')
+        self.bot.metrics.remove_gauge('music_servers')
+
+    @property
+    def queued(self):
+        return sum(len(g.queue) for g in self.guilds.values())
 
     async def _command_play_song(self, message, url, channel):
         """<voice channel> <youtube url>"""
-        if self.player:
-            self.stop_player()
-            await self.play_future
-
         check = lambda c: c.name == channel and c.type == discord.ChannelType.voice
         channel = discord.utils.find(check, message.server.channels)
         if channel is None:
-            await self.bot.client.send_message(
+            await self.bot.send_message(
                 message.channel,
                 'Does that channel even exist ? :|')
             return
 
+        guild = self.guilds.get(message.server.id)
+        if guild is not None and guild.is_running:
+            await self.bot.send_message(
+                message.channel,
+                'Queued, %d song(s) before it' % (len(guild.queue) + 1))
+
         self.play_song(channel, url)
 
+    async def _command_skip_song(self, message):
+        """skip the currently playing song"""
+        if message.author.id not in self.whitelist:
+            await self.bot.send_message(message.channel, "Nah, not you.")
+            return
+
+        guild = self.guilds.get(message.server.id)
+        if guild:
+            guild.skip()
+
     async def _command_stop_song(self, message):
-        """stop the currently playing song"""
+        """stop the currently playing song and clear the queue"""
         if message.author.id not in self.whitelist:
-            await self.bot.client.send_message(message.channel, "Nah, not you.")
+            await self.bot.send_message(message.channel, "Nah, not you.")
             return
 
-        self.stop_player()
+        guild = self.guilds.get(message.server.id)
+        if guild:
+            guild.stop_player()
 
     async def _command_add_user(self, message, user_id):
         self.add_user(user_id)
-        await self.bot.client.send_message(message.channel, "Done :)")
+        await self.bot.send_message(message.channel, "Done :)")
 
     async def _command_remove_user(self, message, user_id):
         self.remove_user(user_id)
-        await self.bot.client.send_message(message.channel, "Done :)")
+        await self.bot.send_message(message.channel, "Done :)")
 
     def add_user(self, user_id):
         """
@@ -98,44 +265,10 @@ class MusicPlayer(object):
         self.db['whitelist'] = wl
 
     def play_song(self, channel, url):
-        if self.player:
-            log.warning('Something already playing')
-            return
-
-        self.play_future = asyncio.ensure_future(
-            self._play_song(channel, url), loop=self.loop)
-
-    async def _play_song(self, channel, url):
-        if self.player:
-            log.warning('Something already playing')
-            return
-
-        log.info('Joining voice channel %s', channel)
-        voice = await self.bot.client.join_voice_channel(channel)
-        self.ended.clear()
-        log.info('Playing song from url %s', url)
-        ydl_opts = {'logger': log}
-        self.player = await voice.create_ytdl_player(
-            url, use_avconv=self.use_avconv, after=self.stop_player, options=ydl_opts)
-        self.player.start()
-        log.info('Waiting for it to end...')
-        await self.ended.wait()
-        await voice.disconnect()
-
-    def resume_player(self):
-        if self.player and not self.player.is_playing():
-            log.info('Resuming paused player')
-            self.player.resume()
-
-    def pause_player(self):
-        if self.player and self.player.is_playing():
-            log.info('Pausing player')
-            self.player.pause()
-
-    def stop_player(self):
-        if self.player and self.player.is_playing():
-            log.info('Something playing, stopping it')
-            self.player.stop()
-            log.info('Player stopped')
-        self.player = None
-        self.ended.set()
+        """
+        Queue a song on the channel's server
+        """
+        guild = self.guilds.get(channel.server.id)
+        if guild is None:
+            guild = self.guilds[channel.server.id] = GuildPlayer(self, channel.server)
+        guild.enqueue(channel, url)
@@ -0,0 +1,153 @@
+import asyncio
+from collections import deque
+import discord
+import logging
+from time import monotonic
+
+from executor import TokenBucket
+
+
+log = logging.getLogger(__name__)
+
+
+class Outbox(object):
+
+    """
+    Every outgoing message goes through here, one queue per destination
+    (channel or private message).
+        - consecutive messages to the same destination are merged in a
+          single send, up to discord's 2000 characters limit
+        - each destination has a token bucket following discord's
+          5 messages per 5 seconds per channel
+        - 429 and 5xx answers are retried with an exponential backoff,
+          honoring retry_after when given
+    """
+
+    MAX_LENGTH = 2000
+    # Drop idle buckets once there are that many of them
+    MAX_BUCKETS = 10000
+
+    def __init__(self, client, rate=1, burst=5, retries=5, backoff=1, loop=None):
+        self.client = client
+        self.loop = loop or asyncio.get_event_loop()
+        self.rate = rate
+        self.burst = burst
+        self.retries = retries
+        self.backoff = backoff
+
+        self._queues = dict()
+        self._buckets = dict()
+        self._workers = dict()
+
+        self.stats = {
+            'queued': 0,
+            'sent': 0,
+            'coalesced': 0,
+            'retries': 0,
+            'failed': 0,
+        }
+
+    @property
+    def pending(self):
+        return sum(len(q) for q in self._queues.values())
+
+    def send(self, destination, content):
+        """
+        Queue a message, return a future resolved with the sent message
+        """
+        future = asyncio.Future(loop=self.loop)
+        key = destination.id
+        self._queues.setdefault(key, deque()).append((content, future))
+        self.stats['queued'] += 1
+        if key not in self._workers:
+            self._workers[key] = asyncio.ensure_future(
+                self._worker(key, destination), loop=self.loop)
+        return future
+
+    async def stop(self, timeout=2):
+        if self._workers:
+            await asyncio.wait(list(self._workers.values()), timeout=timeout)
+
+    def _next_batch(self, queue):
+        content, future = queue.popleft()
+        futures = [future]
+        while queue and len(content) + 1 + len(queue[0][0]) <= self.MAX_LENGTH:
+            next_content, future = queue.popleft()
+            content += '\n' + next_content
+            futures.append(future)
+        self.stats['coalesced'] += len(futures) - 1
+        return content, futures
+
+    async def _wait_bucket(self, key):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.MAX_BUCKETS:
+                self._prune(monotonic())
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.burst, monotonic())
+        while not bucket.take(monotonic()):
+            await asyncio.sleep((1 - bucket.tokens) / bucket.rate)
+
+    def _prune(self, now):
+        """
+        Forget the destinations with nothing to send and a full bucket,
+        which a new bucket would be the same as
+        """
+        for key, bucket in list(self._buckets.items()):
+            if key in self._workers:
+                continue
+            bucket.refill(now)
+            if bucket.tokens >= bucket.capacity:
+                del self._buckets[key]
+
+    @staticmethod
+    def _retry_after(exc):
+        """
+        Seconds to wait before retrying a failed send, None if it should
+        not be retried
+        """
+        retry_after = getattr(exc, 'retry_after', None)
+        if retry_after is not None:
+            return retry_after
+        status = getattr(getattr(exc, 'response', None), 'status', None)
+        if status == 429 or (status is not None and status >= 500):
+            return 0
+        return None
+
+    async def _deliver(self, key, destination, content):
+        for attempt in range(self.retries + 1):
+            await self._wait_bucket(key)
+            try:
+                return await self.client.send_message(destination, content)
+            except discord.HTTPException as exc:
+                retry_after = self._retry_after(exc)
+                if retry_after is None or attempt == self.retries:
+                    raise
+                delay = max(retry_after, self.backoff * 2 ** attempt)
+                log.warning('Send to %s failed (%s), retrying in %.1fs',
+                            key, exc, delay)
+                self.stats['retries'] += 1
+                # Hold the whole destination, its bucket is exhausted
+                self._buckets[key].tokens = 0
+                await asyncio.sleep(delay)
+
+    async def _worker(self, key, destination):
+        queue = self._queues[key]
+        try:
+            while queue:
+                content, futures = self._next_batch(queue)
+                try:
+                    message = await self._deliver(key, destination, content)
+                except Exception as exc:
+                    log.error('Could not send message to %s: %s', key, exc)
+                    self.stats['failed'] += 1
+                    for future in futures:
+                        if not future.done():
+                            future.set_exception(exc)
+                else:
+                    self.stats['sent'] += 1
+                    for future in futures:
+                        if not future.done():
+                            future.set_result(message)
+        finally:
+            del self._workers[key]
+            del self._queues[key]
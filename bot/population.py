@@ -0,0 +1,88 @@
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+class Population(object):
+
+    """
+    Server, member and unique user counts, kept up to date from the
+    gateway events instead of walking every member list on demand.
+    Users sharing several servers with the bot are counted once.
+    """
+
+    def __init__(self):
+        # {server_id: set of member ids}
+        self.servers = dict()
+        # {user_id: number of servers shared with the bot}
+        self.users = dict()
+        self.members = 0
+
+    def counts(self):
+        return {
+            'servers': len(self.servers),
+            'members': self.members,
+            'users': len(self.users),
+        }
+
+    def reset(self, servers):
+        self.servers.clear()
+        self.users.clear()
+        self.members = 0
+        for server in servers:
+            self.add_server(server)
+
+    def add_server(self, server):
+        # Replace what we knew, e.g. for a server becoming available again
+        self.remove_server(server.id)
+        self.servers[server.id] = set()
+        for member in server.members:
+            self.add_member(server.id, member.id)
+
+    def remove_server(self, server_id):
+        members = self.servers.pop(server_id, None)
+        if members is None:
+            return
+        self.members -= len(members)
+        for user_id in members:
+            self._release(user_id)
+
+    def add_member(self, server_id, user_id):
+        members = self.servers.setdefault(server_id, set())
+        if user_id in members:
+            return
+        members.add(user_id)
+        self.members += 1
+        self.users[user_id] = self.users.get(user_id, 0) + 1
+
+    def remove_member(self, server_id, user_id):
+        members = self.servers.get(server_id)
+        if members is None or user_id not in members:
+            return
+        members.remove(user_id)
+        self.members -= 1
+        self._release(user_id)
+
+    def _release(self, user_id):
+        count = self.users[user_id] - 1
+        if count:
+            self.users[user_id] = count
+        else:
+            del self.users[user_id]
+
+    @staticmethod
+    def recount(servers):
+        """
+        The same counts out of a full scan, to check the incremental ones
+        """
+        members = 0
+        users = set()
+        for server in servers:
+            members += len(server.members)
+            users.update(member.id for member in server.members)
+        return {
+            'servers': len(servers),
+            'members': members,
+            'users': len(users),
+        }
@@ -0,0 +1,147 @@
+import asyncio
+from collections import Counter
+from datetime import datetime
+import discord
+import logging
+import os
+import sys
+import threading
+from time import monotonic, sleep
+
+
+log = logging.getLogger(__name__)
+
+
+class SlowCallbackHandler(logging.Handler):
+
+    """
+    Catch asyncio's debug mode warnings about slow callbacks
+    """
+
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.records = []
+
+    def emit(self, record):
+        if isinstance(record.msg, str) and record.msg.startswith('Executing '):
+            self.records.append(record.getMessage())
+
+
+class Profiler(object):
+
+    """
+    Sample the event loop thread's stack from another thread for a given
+    duration, write the samples as collapsed stacks (flamegraph.pl input)
+    and DM a summary to the admin.
+    While running, asyncio's debug mode reports callbacks blocking the
+    loop for more than `slow_callback` seconds.
+    Nothing runs while it is off.
+    """
+
+    def __init__(self, bot, interval=0.005, slow_callback=0.1, loop=None):
+        self.bot = bot
+        self.loop = loop or asyncio.get_event_loop()
+        self.interval = interval
+        self.slow_callback = slow_callback
+
+        self._thread = None
+        self._stopping = threading.Event()
+        self._samples = Counter()
+        self._slow = None
+        self._task = None
+        self._loop_thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    async def start(self):
+        self.bot.add_command(
+            'profile', self._command_profile,
+            admin=True, regexp=r'^(?P<seconds>\d+)?$')
+        self.bot.add_command('profile_stop', self._command_stop, admin=True)
+
+    async def stop(self):
+        if self.running:
+            self._stopping.set()
+        if self._task:
+            await self._task
+        self.bot.remove_command('profile')
+        self.bot.remove_command('profile_stop')
+
+    async def _command_profile(self, message, seconds=None):
+        """profile the bot for <seconds> (default 30)"""
+        if self.running:
+            await self.bot.send_message(message.channel, 'Already profiling')
+            return
+        seconds = int(seconds or 30)
+        self._task = asyncio.ensure_future(self.profile(seconds), loop=self.loop)
+        await self.bot.send_message(
+            message.channel, 'Profiling for %d seconds' % seconds)
+
+    async def _command_stop(self, message):
+        """stop the running profile early"""
+        self._stopping.set()
+
+    async def profile(self, seconds):
+        self._samples.clear()
+        self._stopping.clear()
+        self._loop_thread = threading.get_ident()
+
+        # Report slow callbacks while profiling only, debug mode is costly
+        debug = self.loop.get_debug()
+        slow_callback = self.loop.slow_callback_duration
+        self._slow = SlowCallbackHandler()
+        logging.getLogger('asyncio').addHandler(self._slow)
+        self.loop.slow_callback_duration = self.slow_callback
+        self.loop.set_debug(True)
+
+        self._thread = threading.Thread(
+            target=self._sample, args=(seconds,), name='profiler', daemon=True)
+        start = monotonic()
+        self._thread.start()
+        try:
+            await self.loop.run_in_executor(None, self._thread.join)
+        finally:
+            self.loop.set_debug(debug)
+            self.loop.slow_callback_duration = slow_callback
+            logging.getLogger('asyncio').removeHandler(self._slow)
+            self._thread = None
+
+        filename = 'profile-%s.folded' % datetime.now().strftime('%Y%m%d-%H%M%S')
+        with open(filename, 'w') as f:
+            for stack, count in self._samples.most_common():
+                f.write('%s %d\n' % (stack, count))
+        log.info('Profile written to %s', filename)
+
+        await self.bot.send_message(
+            discord.User(id=self.bot.admin_id),
+            self.summary(monotonic() - start, filename))
+
+    def _sample(self, seconds):
+        deadline = monotonic() + seconds
+        while monotonic() < deadline and not self._stopping.is_set():
+            frame = sys._current_frames().get(self._loop_thread)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s:%s' % (code.co_filename, code.co_name))
+                frame = frame.f_back
+            self._samples[';'.join(reversed(stack))] += 1
+            sleep(self.interval)
+
+    def summary(self, elapsed, filename):
+        total = sum(self._samples.values()) or 1
+        leaves = Counter()
+        for stack, count in self._samples.items():
+            leaves[os.path.basename(stack.rsplit(';', 1)[-1])] += count
+
+        msg = 'Profiled for %.1fs, %d samples in `%s`\n' % (elapsed, total, filename)
+        msg += 'Top functions:\n'
+        for leaf, count in leaves.most_common(10):
+            msg += '`%5.1f%% %s`\n' % (100 * count / total, leaf)
+        msg += '%d callbacks took more than %dms\n' % (
+            len(self._slow.records), self.slow_callback * 1000)
+        for record in self._slow.records[:5]:
+            msg += '`%s`\n' % record[:150]
+        return msg
@@ -1,10 +1,14 @@
 import asyncio
+from contextlib import contextmanager
 from datetime import timedelta, datetime
 from discord.user import User
+import heapq
 import logging
+import os
 from uuid import uuid4
-import yolodb
 
+from metrics import Histogram
+from storage import connect, open_store, store_path
 from utils import get_time_string
 
 
@@ -15,10 +19,14 @@ class Reminder(object):
 
     def __init__(self, uid, author_id, message, at_time):
         self.uid = uid
-        self.author = User(id=author_id)
+        self.author_id = author_id
         self.message = message
         self.at_time = at_time
 
+    @property
+    def author(self):
+        return User(id=self.author_id)
+
     @classmethod
     def from_dict(cls, **data):
         return cls(**data)
@@ -26,35 +34,278 @@ class Reminder(object):
     def to_dict(self):
         return {
             'uid': self.uid,
-            'author_id': self.author.id,
+            'author_id': self.author_id,
             'message': self.message,
             'at_time': self.at_time
         }
 
 
-"""
-<user_id>
-    <reminder_id>
-        <reminder_id>
-        <author_id>
-        <message>
-        <at_time>
-"""
+class ScheduledReminder(object):
+
+    """
+    Heap entry, only what is needed to find the reminder back in the db
+    """
+
+    __slots__ = ('at_time', 'uid', 'author_id', 'cancelled')
+
+    def __init__(self, at_time, uid, author_id):
+        self.at_time = at_time
+        self.uid = uid
+        self.author_id = author_id
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return self.at_time < other.at_time
+
+
+class LagHistogram(Histogram):
+
+    BUCKETS = (1, 5, 10, 30, 60, 300, 900, 3600, 6 * 3600, 86400)
+
+    __slots__ = ()
+
+
+class ReminderScheduler(object):
+
+    """
+    Keep every pending reminder in a single min-heap on at_time and fire
+    them from one task, sleeping until the earliest deadline.
+    Entries due at once are handed to the callback in a single list.
+    Cancelled entries are left in the heap as tombstones and skipped.
+    """
+
+    def __init__(self, callback, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.callback = callback
+        self._heap = []
+        self._entries = dict()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, uid):
+        return uid in self._entries
+
+    def entries(self):
+        return list(self._entries.values())
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run(), loop=self.loop)
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.wait([self._task])
+            self._task = None
+
+    def schedule(self, uid, author_id, at_time):
+        self.cancel(uid)
+        entry = ScheduledReminder(at_time, uid, author_id)
+        self._entries[uid] = entry
+        heapq.heappush(self._heap, entry)
+        if self._heap[0] is entry:
+            # New earliest deadline, wake the task up
+            self._wakeup.set()
+
+    def cancel(self, uid):
+        entry = self._entries.pop(uid, None)
+        if entry is None:
+            return False
+        entry.cancelled = True
+        # Rebuild the heap once tombstones outnumber live entries
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._heap = [e for e in self._heap if not e.cancelled]
+            heapq.heapify(self._heap)
+        return True
+
+    async def _run(self):
+        while True:
+            now = datetime.now().timestamp()
+            due = []
+            while self._heap and self._heap[0].at_time <= now:
+                entry = heapq.heappop(self._heap)
+                if entry.cancelled:
+                    continue
+                del self._entries[entry.uid]
+                due.append(entry)
+            if due:
+                try:
+                    self.callback(due)
+                except Exception:
+                    log.exception('Callback failed for %d reminders', len(due))
+
+            self._wakeup.clear()
+            timeout = self._heap[0].at_time - now if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+class ReminderTable(object):
+
+    """
+    Every reminder in one SQLite table indexed on at_time, of which only
+    the ones due within a window are read at once. Its queries are short
+    and indexed, they are run on the loop.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = connect(path)
+        with self.transaction():
+            # The shards starting at once, only one of them creates it
+            self.created = not self.conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'reminders'"
+            ).fetchone()
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS reminders ('
+                'uid TEXT PRIMARY KEY, author_id TEXT NOT NULL, message TEXT NOT NULL, '
+                'at_time INTEGER NOT NULL, dead INTEGER NOT NULL DEFAULT 0)')
+            self.conn.execute(
+                'CREATE INDEX IF NOT EXISTS reminders_at_time ON reminders (dead, at_time)')
+            self.conn.execute(
+                'CREATE INDEX IF NOT EXISTS reminders_author ON reminders (author_id)')
+
+    @contextmanager
+    def transaction(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except Exception:
+            self.conn.execute('ROLLBACK')
+            raise
+        self.conn.execute('COMMIT')
+
+    def add(self, reminders):
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO reminders (uid, author_id, message, at_time, dead) '
+            'VALUES (?, ?, ?, ?, ?)',
+            [(r['uid'], r['author_id'], r['message'], r['at_time'], int(r.get('dead', False)))
+             for r in reminders])
+
+    def remove(self, uids):
+        """
+        Return the number of live reminders removed
+        """
+        params = [(uid,) for uid in uids]
+        live = self.conn.executemany(
+            'DELETE FROM reminders WHERE uid = ? AND dead = 0', params).rowcount
+        self.conn.executemany('DELETE FROM reminders WHERE uid = ?', params)
+        return live
+
+    def bury(self, uids):
+        """
+        Return the number of reminders buried
+        """
+        return self.conn.executemany(
+            'UPDATE reminders SET dead = 1 WHERE uid = ? AND dead = 0',
+            [(uid,) for uid in uids]).rowcount
+
+    def by_author(self, author_id):
+        """
+        {uid: reminder dict} of a user
+        """
+        rows = self.conn.execute(
+            'SELECT uid, author_id, message, at_time, dead FROM reminders '
+            'WHERE author_id = ? ORDER BY at_time', (author_id,))
+        return dict((row[0], self._reminder(row)) for row in rows)
+
+    def due(self, until):
+        """
+        (at_time, uid, author_id) of the live reminders due before `until`
+        """
+        return self.conn.execute(
+            'SELECT at_time, uid, author_id FROM reminders '
+            'WHERE dead = 0 AND at_time < ?', (until,)).fetchall()
+
+    def count(self):
+        """
+        Number of live reminders. Its own connection, to be run on a thread
+        """
+        conn = connect(self.path)
+        try:
+            return conn.execute(
+                'SELECT count(*) FROM reminders WHERE dead = 0').fetchone()[0]
+        finally:
+            conn.close()
+
+    def close(self):
+        self.conn.close()
+
+    @staticmethod
+    def _reminder(row):
+        uid, author_id, message, at_time, dead = row
+        reminder = Reminder(uid, author_id, message, at_time).to_dict()
+        if dead:
+            reminder['dead'] = True
+        return reminder
 
 
 class ReminderManager(object):
 
-    def __init__(self, bot, loop=None):
+    """
+    Due reminders are delivered at least once: they are grouped in one
+    DM per recipient and only removed from the db once sent, in a single
+    batch for every delivery done in the same tick. Failed sends are
+    retried with an exponential backoff, up to `retries` times, after
+    which the reminders are marked dead and left in the db.
+    When sharded, every shard adds reminders to the shared table but only
+    shard 0 delivers them, looking for the new ones every poll_interval
+    seconds.
+    """
+
+    def __init__(self, bot, horizon=6 * 3600, retries=5, backoff=2,
+                 count_interval=60, poll_interval=10, loop=None):
         self.bot = bot
         self.loop = loop or asyncio.get_event_loop()
-        self.db = None
-        self.running_tasks = dict()
+        self.horizon = horizon
+        self.retries = retries
+        self.backoff = backoff
+        self.table = None
+        self.scheduler = ReminderScheduler(self._due, loop=self.loop)
+        self.delivering = not bot.sharded or bot.shard_id == 0
+        self.poll_interval = poll_interval
+        # Last bucket loaded into the scheduler
+        self.loaded_until = None
+        self._pager = None
+        # Live reminders in the table, whatever their time, counted again
+        # every count_interval seconds
+        self.count_interval = count_interval
+        self.pending = 0
+        self._counter = None
+
+        # Due reminders being delivered, {uid: scheduler entry}
+        self.inflight = dict()
+        self._deliveries = set()
+        # Delivered reminders waiting to be removed, [(author_id, uid)]
+        self._delivered = []
+        self._removal = None
+        self.delivery = {'delivered': 0, 'retries': 0, 'dead': 0}
+        self.lag = LagHistogram()
 
     async def start(self):
-        self.db = await yolodb.load('reminder.db', loop=self.loop)
-        for user in self.db.all.values():
-            for reminder in user.values():
-                self._prepare_reminder(Reminder.from_dict(**reminder))
+        self.table = ReminderTable('reminders.sqlite3')
+        if self.table.created:
+            await self._migrate()
+
+        if self.delivering:
+            # Only arm what is due within the current and next window
+            self._page_in(self._bucket(datetime.now().timestamp()) + 1)
+            self.scheduler.start()
+            self._pager = asyncio.ensure_future(self._page_task(), loop=self.loop)
+        self._counter = asyncio.ensure_future(self._count_task(), loop=self.loop)
+
+        self.bot.metrics.add_gauge('reminders_pending', lambda: self.pending)
+        self.bot.metrics.add_gauge('reminders_scheduled', lambda: len(self.scheduler))
+        self.bot.metrics.add_gauge('reminders_inflight', lambda: len(self.inflight))
+        self.bot.metrics.add_gauge(
+            'reminders_delivered', lambda: self.delivery['delivered'])
+        self.bot.metrics.add_gauge('reminders_dead', lambda: self.delivery['dead'])
+        self.bot.metrics.add_gauge(
+            'reminder_lag_p99_seconds', lambda: self.lag.quantile(0.99))
 
         self.bot.add_command(
             'reminder', self._command,
@@ -69,8 +320,40 @@ class ReminderManager(object):
             regexp=r'^(?P<uid>\w{8})$')
 
     async def stop(self):
-        await self.db.close()
+        for task in (self._pager, self._counter):
+            if task:
+                task.cancel()
+        await self.scheduler.stop()
+        for task in list(self._deliveries):
+            task.cancel()
+        # Reminders still being delivered are armed again at the next start
+        self._remove_delivered()
+        self.table.close()
         self.bot.remove_command('reminder')
+        for name in ('reminders_pending', 'reminders_scheduled', 'reminders_inflight',
+                     'reminders_delivered', 'reminders_dead', 'reminder_lag_p99_seconds'):
+            self.bot.metrics.remove_gauge(name)
+
+    async def _migrate(self):
+        """
+        Copy the reminders of the former reminder.db, once
+        """
+        backend = self.bot.conf.get('storage', 'yolodb')
+        reminders = []
+        # Sharded bots used to keep one reminder-<shard>.db each
+        for path in ['reminder.db'] + ['reminder-%d.db' % shard_id
+                                       for shard_id in range(self.bot.shard_count or 0)]:
+            if not os.path.exists(store_path(path, backend)):
+                continue
+            db = await open_store(path, backend, loop=self.loop)
+            reminders.extend(
+                reminder for user in db.all.values() for reminder in user.values())
+            await db.close()
+        if reminders:
+            with self.table.transaction():
+                self.table.add(reminders)
+            log.info('%d reminders migrated, reminder.db and reminder_index.db '
+                     'can be removed', len(reminders))
 
     async def _command(self, message, remind=None,
                        days=None, hours=None, minutes=None, seconds=None):
@@ -94,7 +377,7 @@ class ReminderManager(object):
         self.new(message.author.id, at_time, msg)
         response = 'Aight! I will ping you :)'
 
-        await self.bot.client.send_message(message.channel, response)
+        await self.bot.send_message(message.channel, response)
 
     async def _command_list(self, message):
         """List your reminders"""
@@ -105,54 +388,170 @@ class ReminderManager(object):
         else:
             msg = 'Here are your current reminders:\n'
             for reminder in reminders.values():
+                if reminder.get('dead'):
+                    msg += '`%s` "%s" could not be delivered\n' % (reminder['uid'], reminder['message'])
+                    continue
                 in_time = reminder['at_time'] - int(datetime.now().timestamp())
                 msg += '`%s` "%s" in %s\n' % (reminder['uid'], reminder['message'], get_time_string(in_time))
 
-        await self.bot.client.send_message(message.author, msg)
+        await self.bot.send_message(message.author, msg)
 
     async def _command_delete(self, message, uid):
         """Remove the given reminder by uid"""
-        if uid in self.running_tasks:
+        if uid in self.get_reminders(message.author.id):
             self._pop_reminder(message.author.id, uid)
             msg = 'Reminder deleted :)'
         else:
             msg = "Don't know about this one, check your list again"
-        await self.bot.client.send_message(message.channel, msg)
+        await self.bot.send_message(message.channel, msg)
 
     def new(self, author_id, at_time, message):
         """
         Take the raw (0d0h0m0s) message and convert it into a reminder
         """
         uid = str(uuid4())[:8]
-        reminders = self.db.get(author_id, {})
         new = Reminder(uid, author_id, message, at_time)
-        reminders[uid] = new.to_dict()
-        self.db[author_id] = reminders
-        self._prepare_reminder(new)
+        with self.table.transaction():
+            self.table.add([new.to_dict()])
+        self.pending += 1
+
+        if self.delivering and self._bucket(at_time) <= self.loaded_until:
+            self._prepare_reminder(new)
         return True
 
     def get_reminders(self, user_id):
-        return self.db.get(user_id, {})
+        return self.table.by_author(user_id)
 
     def _pop_reminder(self, author_id, reminder_id):
-        reminders = self.db.get(author_id, {})
-        del reminders[reminder_id]
-        if not reminders:
-            self.db.pop(author_id)
-        else:
-            self.db[author_id] = reminders
-        if reminder_id in self.running_tasks:
-            self.running_tasks[reminder_id].cancel()
-            del self.running_tasks[reminder_id]
+        with self.table.transaction():
+            self._pop_reminders([reminder_id])
+
+    def _pop_reminders(self, reminder_ids):
+        for reminder_id in reminder_ids:
+            self.inflight.pop(reminder_id, None)
+            self.scheduler.cancel(reminder_id)
+        self.pending -= self.table.remove(reminder_ids)
 
     def _prepare_reminder(self, reminder):
         delay = (reminder.at_time - datetime.now().timestamp())
         log.info('Reminder will be sent in %d seconds', delay)
+        self.scheduler.schedule(reminder.uid, reminder.author_id, reminder.at_time)
 
-        def send():
-            asyncio.ensure_future(self.bot.client.send_message(
-                reminder.author, '`Reminder` ' + reminder.message
-            ), loop=self.loop)
-            self._pop_reminder(reminder.author.id, reminder.uid)
+    def _due(self, entries):
+        """
+        Start delivering due reminders, one delivery per recipient
+        """
+        recipients = dict()
+        for entry in entries:
+            self.inflight[entry.uid] = entry
+            recipients.setdefault(entry.author_id, []).append(entry)
+        for author_id, entries in recipients.items():
+            # Joined in this order by the outbox, the heap only orders at_time
+            entries.sort(key=lambda e: (e.at_time, e.uid))
+            task = asyncio.ensure_future(self._deliver(author_id, entries), loop=self.loop)
+            self._deliveries.add(task)
+            task.add_done_callback(self._deliveries.discard)
+
+    async def _deliver(self, author_id, entries):
+        """
+        Send the reminders in a single DM, the outbox merging them (up to
+        2000 characters per message), until all went through
+        """
+        user = User(id=author_id)
+        attempt = 0
+        while True:
+            reminders = self.get_reminders(author_id)
+            entries = [e for e in entries if e.uid in reminders]
+            if not entries:
+                # Deleted meanwhile
+                return
+            results = await asyncio.gather(
+                *[self.bot.send_message(user, '`Reminder` ' + reminders[e.uid]['message'])
+                  for e in entries],
+                return_exceptions=True)
+            sent_at = datetime.now().timestamp()
+            failed = []
+            for entry, result in zip(entries, results):
+                if isinstance(result, Exception):
+                    failed.append(entry)
+                    continue
+                self.lag.observe(max(0, sent_at - entry.at_time))
+                self._delivered.append((author_id, entry.uid))
+            self.delivery['delivered'] += len(entries) - len(failed)
+            if self._delivered and self._removal is None:
+                self._removal = self.loop.call_soon(self._remove_delivered)
+
+            entries = failed
+            if not entries:
+                return
+            if attempt == self.retries:
+                break
+            delay = self.backoff * 2 ** attempt
+            attempt += 1
+            log.warning('Could not deliver %d reminders to %s, retrying in %ds',
+                        len(entries), author_id, delay)
+            self.delivery['retries'] += len(entries)
+            await asyncio.sleep(delay)
+
+        log.error('Giving up on %d reminders for %s', len(entries), author_id)
+        self._bury(author_id, entries)
+
+    def _remove_delivered(self):
+        if self._removal is not None:
+            self._removal.cancel()
+            self._removal = None
+        delivered, self._delivered = self._delivered, []
+        if not delivered:
+            return
+        with self.table.transaction():
+            self._pop_reminders([uid for author_id, uid in delivered])
+
+    def _bury(self, author_id, entries):
+        """
+        Keep undeliverable reminders in the db for the user to see, but
+        never scheduled again
+        """
+        self.delivery['dead'] += len(entries)
+        for entry in entries:
+            self.inflight.pop(entry.uid, None)
+        with self.table.transaction():
+            self.pending -= self.table.bury([entry.uid for entry in entries])
+
+    def _bucket(self, at_time):
+        return int(at_time // self.horizon)
+
+    def _page_in(self, until):
+        """
+        Schedule every reminder due up to the given bucket (included),
+        overdue ones included
+        """
+        count = 0
+        for at_time, uid, author_id in self.table.due((until + 1) * self.horizon):
+            if uid in self.scheduler or uid in self.inflight:
+                continue
+            self.scheduler.schedule(uid, author_id, at_time)
+            count += 1
+        self.loaded_until = until
+        log.info('Loaded %d reminders up to bucket %d', count, until)
 
-        self.running_tasks[reminder.uid] = self.loop.call_later(delay, send)
+    async def _count_task(self):
+        """
+        Count the pending reminders again, e.g. the ones added or removed
+        by another process
+        """
+        while True:
+            self.pending = await self.loop.run_in_executor(None, self.table.count)
+            await asyncio.sleep(self.count_interval)
+
+    async def _page_task(self):
+        """
+        Page the next window in each time a window boundary is crossed,
+        and the current one again every poll_interval when sharded
+        """
+        while True:
+            now = datetime.now().timestamp()
+            delay = (self._bucket(now) + 1) * self.horizon - now
+            if self.bot.sharded:
+                delay = min(delay, self.poll_interval)
+            await asyncio.sleep(delay)
+            self._page_in(self._bucket(datetime.now().timestamp()) + 1)
@@ -0,0 +1,539 @@
+#!/usr/bin/env python
+"""
+Replay a stream of gateway events against the real bot and its modules,
+without any connection to discord, and report throughput, per handler
+latency and peak memory.
+
+Events come from a JSON lines recording or are generated:
+    {"type": "ready", "servers": [{"id": "1", "members": [{"id": "2", "game": "Dota 2"}]}]}
+    {"type": "presence", "server": "1", "user": "2", "game": null}
+    {"type": "message", "server": "1", "user": "2", "content": "!go played"}
+    {"type": "join", "server": "1", "user": "3"}
+    {"type": "leave", "server": "1", "user": "3"}
+    {"type": "server_remove", "server": "1"}
+    {"type": "server_join", "server": {"id": "1", "members": [{"id": "2", "game": null}]}}
+    {"type": "drop", "resume": false}
+
+The process exits with 1 when a handler's p99 is above --max-p99, or when
+the population counters differ from a full recount, so that it can be used
+as a regression gate.
+On a "drop" event the fake gateway drops the connection, and the replay
+waits for the bot to reconnect, resuming the session or not. After a full
+reconnection, the game sessions must match the presences again.
+
+With --startup, it times instead the cold start, from process start to a
+handled on_ready, with every module loaded at start and with the default
+lazy loading.
+"""
+import asyncio
+from collections import namedtuple
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+from time import monotonic
+
+
+log = logging.getLogger(__name__)
+
+
+Game = namedtuple('Game', 'name')
+
+
+class FakeUser(object):
+
+    def __init__(self, id, game=None):
+        self.id = id
+        self.name = 'user%s' % id
+        self.game = Game(game) if game else None
+
+    def copy(self, game):
+        return FakeUser(self.id, game)
+
+
+class FakeChannel(object):
+
+    def __init__(self, id, server=None):
+        self.id = id
+        self.name = 'channel%s' % id
+        self.server = server
+        self.is_private = server is None
+        self.type = None
+
+
+class FakeServer(object):
+
+    def __init__(self, id):
+        self.id = id
+        self._members = dict()
+        self.channels = [FakeChannel('c%s' % id, self)]
+
+    @property
+    def members(self):
+        return list(self._members.values())
+
+    def member(self, user_id):
+        return self._members.get(user_id)
+
+    def set_member(self, member):
+        member.server = self
+        self._members[member.id] = member
+
+    def remove_member(self, user_id):
+        return self._members.pop(user_id, None)
+
+
+class FakeMessage(object):
+
+    def __init__(self, content, author, channel):
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.server = getattr(channel, 'server', None)
+        self.attachments = []
+
+
+class FakeClient(object):
+
+    """
+    Enough of connection.Client for the bot, sent messages are only
+    counted. The connection is dropped on demand, and a reconnection
+    which does not resume the session dispatches on_ready again.
+    """
+
+    def __init__(self, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.servers = []
+        self.sent = 0
+        self.session = None
+        self.connections = 0
+        self.connected = asyncio.Event()
+        self._closed = asyncio.Event()
+        self._dropped = asyncio.Event()
+
+    def event(self, coro):
+        setattr(self, coro.__name__, coro)
+        return coro
+
+    async def login(self, *args, **kwargs):
+        pass
+
+    @property
+    def can_resume(self):
+        return self.session is not None
+
+    def reopen(self):
+        pass
+
+    async def connect(self, resume=False):
+        self.connections += 1
+        if not resume:
+            self.session = object()
+            # The first ready comes from the replayed events
+            if self.connections > 1:
+                await self.on_ready()
+        self._dropped.clear()
+        self.connected.set()
+        closed = asyncio.ensure_future(self._closed.wait())
+        dropped = asyncio.ensure_future(self._dropped.wait())
+        await asyncio.wait([closed, dropped], return_when=asyncio.FIRST_COMPLETED)
+        closed.cancel()
+        dropped.cancel()
+        if self._dropped.is_set() and not self._closed.is_set():
+            raise ConnectionResetError('Dropped by the replay')
+
+    def drop(self, resume=True):
+        """
+        Drop the connection, the session being lost unless `resume`
+        """
+        if not resume:
+            self.session = None
+        self.connected.clear()
+        self._dropped.set()
+
+    async def logout(self):
+        self._closed.set()
+
+    async def send_message(self, destination, content):
+        self.sent += 1
+        return FakeMessage(content, None, destination)
+
+    async def accept_invite(self, invite):
+        pass
+
+    async def join_voice_channel(self, channel):
+        raise RuntimeError('No voice in replay')
+
+
+def synthetic(servers=10, members=1000, events=100000, messages=0.01,
+              games=50, playing=0.3, mutual=1, churn=0.001, drops=0,
+              prefix='!go', seed=0):
+    """
+    A ready event followed by random presence updates and commands.
+    Each user is in `mutual` servers, and sends a presence update to each
+    of them on a game change, as discord does.
+    A `churn` ratio of the events are members joining or leaving, one in
+    ten of them being a whole server leaving and coming back.
+    A `drops` ratio of the events are dropped connections, half of them
+    resumable.
+    """
+    rand = random.Random(seed)
+    games = ['game %d' % i for i in range(games)]
+    commands = ['played', 'top', 'stats', 'reminder 1h test', 'reminder_list', 'info']
+    users = max(1, servers * members // mutual)
+
+    def user_servers(user):
+        return [str((user + k) % servers) for k in range(mutual)]
+
+    ready = dict((str(s), []) for s in range(servers))
+    for user in range(users):
+        game = rand.choice(games) if rand.random() < playing else None
+        for server in user_servers(user):
+            ready[server].append({'id': str(user), 'game': game})
+    yield {'type': 'ready', 'servers': [
+        {'id': server, 'members': members} for server, members in ready.items()]}
+
+    for _ in range(events):
+        user = rand.randrange(users)
+        draw = rand.random()
+        if draw < drops:
+            yield {'type': 'drop', 'resume': rand.random() < 0.5}
+            continue
+        draw -= drops
+        if draw < churn / 10:
+            server = rand.choice(list(ready))
+            yield {'type': 'server_remove', 'server': server}
+            yield {'type': 'server_join', 'server': {
+                'id': server, 'members': ready[server]}}
+        elif draw < churn:
+            yield {'type': rand.choice(('join', 'leave')),
+                   'server': rand.choice(user_servers(user)), 'user': str(user)}
+        elif draw < churn + messages:
+            yield {'type': 'message', 'server': user_servers(user)[0],
+                   'user': str(user),
+                   'content': '%s %s' % (prefix, rand.choice(commands))}
+        else:
+            game = rand.choice(games) if rand.random() < playing else None
+            for server in user_servers(user):
+                yield {'type': 'presence', 'server': server,
+                       'user': str(user), 'game': game}
+
+
+def recorded(path):
+    with open(path, 'r') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class Replay(object):
+
+    def __init__(self, bot, rate=0):
+        self.bot = bot
+        self.client = bot.client
+        self.rate = rate
+        self.servers = dict()
+        self.latencies = dict()
+        self.events = 0
+        self.reconnects = {'resumed': 0, 'full': 0, 'sessions_kept': 0, 'mismatches': 0}
+
+    async def _timed(self, name, coro):
+        start = monotonic()
+        await coro
+        self.latencies.setdefault(name, []).append(monotonic() - start)
+
+    def _ready(self, event):
+        self.client.servers = [self._server(data) for data in event['servers']]
+        return self.bot.on_ready()
+
+    def _server(self, data):
+        server = FakeServer(data['id'])
+        for member in data['members']:
+            server.set_member(FakeUser(member['id'], member.get('game')))
+        self.servers[server.id] = server
+        return server
+
+    def _presence(self, event):
+        server = self.servers[event['server']]
+        old = server.member(event['user']) or FakeUser(event['user'])
+        new = old.copy(event.get('game'))
+        if server.member(new.id):
+            server.set_member(new)
+        return self.bot.on_member_update(old, new)
+
+    def _join(self, event):
+        server = self.servers[event['server']]
+        member = FakeUser(event['user'])
+        server.set_member(member)
+        return self.bot.on_member_join(member)
+
+    def _leave(self, event):
+        server = self.servers[event['server']]
+        member = server.remove_member(event['user']) or FakeUser(event['user'])
+        member.server = server
+        return self.bot.on_member_remove(member)
+
+    def _server_join(self, event):
+        server = self._server(event['server'])
+        self.client.servers.append(server)
+        return self.bot.on_server_join(server)
+
+    def _server_remove(self, event):
+        server = self.servers.pop(event['server'])
+        self.client.servers.remove(server)
+        return self.bot.on_server_remove(server)
+
+    async def _drop(self, event):
+        resume = event.get('resume', True)
+        before = dict(self.bot.timecounter.playing)
+        self.client.drop(resume)
+        await self.client.connected.wait()
+        playing = self.bot.timecounter.playing
+        self.reconnects['sessions_kept'] += sum(
+            1 for user_id, session in playing.items() if before.get(user_id) is session)
+        if resume:
+            self.reconnects['resumed'] += 1
+            return
+        self.reconnects['full'] += 1
+        expected = dict()
+        for server in self.client.servers:
+            for member in server.members:
+                if member.game:
+                    expected[member.id] = member.game.name
+        if expected != dict((u, s.game) for u, s in playing.items()):
+            self.reconnects['mismatches'] += 1
+
+    def _message(self, event):
+        server = self.servers.get(event.get('server'))
+        channel = server.channels[0] if server else FakeChannel('dm%s' % event['user'])
+        author = (server and server.member(event['user'])) or FakeUser(event['user'])
+        return self.bot.on_message(FakeMessage(event['content'], author, channel))
+
+    async def run(self, events):
+        handlers = {
+            'ready': ('on_ready', self._ready),
+            'presence': ('on_member_update', self._presence),
+            'message': ('on_message', self._message),
+            'join': ('on_member_join', self._join),
+            'leave': ('on_member_remove', self._leave),
+            'server_join': ('on_server_join', self._server_join),
+            'server_remove': ('on_server_remove', self._server_remove),
+            'drop': ('reconnect', self._drop),
+        }
+        start = monotonic()
+        for event in events:
+            name, handler = handlers[event['type']]
+            await self._timed(name, handler(event))
+            self.events += 1
+            if self.rate:
+                delay = start + self.events / self.rate - monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            elif not self.events % 1000:
+                # Let the commands and the modules' tasks run
+                await asyncio.sleep(0)
+        return monotonic() - start
+
+    def population_errors(self):
+        """
+        Counters which drifted from a full recount
+        """
+        counts = self.bot.population.counts()
+        expected = self.bot.population.recount(self.client.servers)
+        return dict((key, (counts[key], value))
+                    for key, value in expected.items() if counts[key] != value)
+
+    def report(self, elapsed):
+        lines = ['%d events in %.2fs, %.0f events/s' % (
+            self.events, elapsed, self.events / elapsed if elapsed else 0)]
+        for name, values in sorted(self.latencies.items()):
+            lines.append('%-18s n=%-8d p50=%.3fms p99=%.3fms max=%.3fms' % (
+                name, len(values), percentile(values, 0.5) * 1000,
+                percentile(values, 0.99) * 1000, max(values) * 1000))
+        for name, histogram in sorted(self.bot.metrics.commands.items()):
+            lines.append('command %-10s n=%-8d p99<=%.0fms' % (
+                name, histogram.count, histogram.quantile(0.99) * 1000))
+        presences = self.bot.timecounter.presences
+        lines.append('presence updates: %d seen, %d forwarded (%.0f%% collapsed)' % (
+            presences.stats['seen'], presences.stats['forwarded'],
+            presences.collapse_ratio * 100))
+        if self.reconnects['resumed'] or self.reconnects['full']:
+            lines.append('reconnects: %(resumed)d resumed, %(full)d full, '
+                         '%(sessions_kept)d sessions kept, '
+                         '%(mismatches)d mismatching the presences' % self.reconnects)
+        errors = self.population_errors()
+        if errors:
+            lines.append('population: MISMATCH %s' % ', '.join(
+                '%s %d instead of %d' % (k, got, want)
+                for k, (got, want) in sorted(errors.items())))
+        else:
+            lines.append('population: %(servers)d servers, %(members)d members, '
+                         '%(users)d users, matching a full recount'
+                         % self.bot.population.counts())
+        lines.append('messages sent: %d, peak memory: %.1fMB' % (
+            self.client.sent,
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+        return '\n'.join(lines)
+
+
+CONF = {
+    'email': '',
+    'password': '',
+    'admin_id': '0',
+    'prefix': '!go',
+    'scrap_invites': False,
+    'music': {},
+    'reconnect': {'base': 0.01, 'cap': 0.1},
+    'commands': {
+        'queue_size': 1000,
+        'user_rate': 1000,
+        'user_burst': 1000,
+        'server_rate': 1000,
+        'server_burst': 1000,
+    },
+}
+
+
+async def eager_modules(bot):
+    """
+    Wait for the modules loaded at start
+    """
+    eager = [name for name, mode in bot.module_modes.items() if mode == 'eager']
+    if eager:
+        await asyncio.wait([bot.load_module(name) for name in eager])
+
+
+async def replay(events, rate=0, loop=None):
+    # Imported here for the logging setup to come first
+    from bot import Bot
+
+    client = FakeClient(loop=loop)
+    bot = Bot(conf=dict(CONF), client=client)
+    started = asyncio.ensure_future(bot.start(), loop=loop)
+    await eager_modules(bot)
+
+    run = Replay(bot, rate)
+    elapsed = await run.run(events)
+    # Wait for the last commands and messages
+    await bot.executor.stop(timeout=10)
+    await bot.outbox.stop(timeout=10)
+    report = run.report(elapsed)
+
+    await bot.stop()
+    await started
+    return run, report
+
+
+async def startup_child(eager, loop=None):
+    from bot import Bot, MODULES
+
+    conf = dict(CONF)
+    if eager:
+        conf['modules'] = dict((name, 'eager') for name in MODULES)
+    client = FakeClient(loop=loop)
+    bot = Bot(conf=conf, client=client)
+    started = asyncio.ensure_future(bot.start(), loop=loop)
+    await eager_modules(bot)
+    await bot.on_ready()
+    print('ready', flush=True)
+    await bot.stop()
+    await started
+
+
+def startup(runs=5):
+    """
+    Median seconds from process start to on_ready, with every module
+    loaded at start then with the default modes
+    """
+    results = dict()
+    for label, argv in (('eager', ['--eager']), ('default', [])):
+        times = []
+        for _ in range(runs):
+            workdir = tempfile.mkdtemp(prefix='startup-')
+            try:
+                start = monotonic()
+                child = subprocess.Popen(
+                    [sys.executable, os.path.abspath(__file__), '--startup-child'] + argv,
+                    cwd=workdir, stdout=subprocess.PIPE, universal_newlines=True)
+                for line in child.stdout:
+                    if line.strip() == 'ready':
+                        times.append(monotonic() - start)
+                        break
+                child.wait()
+            finally:
+                shutil.rmtree(workdir)
+        results[label] = percentile(times, 0.5)
+    return results
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser, SUPPRESS
+
+    parser = ArgumentParser(description='Replay gateway events against the bot')
+    parser.add_argument('recording', nargs='?', help='JSON lines recording')
+    parser.add_argument('--servers', type=int, default=10)
+    parser.add_argument('--members', type=int, default=1000, help='Members per server')
+    parser.add_argument('--events', type=int, default=100000)
+    parser.add_argument('--messages', type=float, default=0.01, help='Ratio of messages')
+    parser.add_argument('--mutual', type=int, default=1, help='Servers per user')
+    parser.add_argument('--churn', type=float, default=0.001, help='Ratio of joins/leaves')
+    parser.add_argument('--drops', type=float, default=0, help='Ratio of dropped connections')
+    parser.add_argument('--rate', type=float, default=0, help='Events per second, 0 for max')
+    parser.add_argument('--max-p99', type=float, help='Fail above this p99 (ms)')
+    parser.add_argument('--startup', action='store_true', help='Time the cold start')
+    parser.add_argument('--startup-child', action='store_true', help=SUPPRESS)
+    parser.add_argument('--eager', action='store_true', help=SUPPRESS)
+    parser.add_argument('-d', '--debug', action='store_true', help='Debug mode')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.ERROR)
+
+    if args.startup_child:
+        # Already in its own work directory
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(startup_child(args.eager, loop=loop))
+        sys.exit(0)
+    if args.startup:
+        results = startup()
+        for label in ('eager', 'default'):
+            print('%-8s %.3fs to on_ready' % (label, results[label]))
+        sys.exit(0)
+
+    if args.recording:
+        events = recorded(os.path.abspath(args.recording))
+    else:
+        events = synthetic(args.servers, args.members, args.events,
+                           args.messages, mutual=args.mutual, churn=args.churn,
+                           drops=args.drops)
+
+    # Keep the databases away from the real ones
+    workdir = tempfile.mkdtemp(prefix='replay-')
+    os.chdir(workdir)
+    try:
+        loop = asyncio.get_event_loop()
+        run, report = loop.run_until_complete(replay(events, args.rate, loop=loop))
+    finally:
+        shutil.rmtree(workdir)
+    print(report)
+
+    if run.population_errors() or run.reconnects['mismatches']:
+        sys.exit(1)
+    if args.max_p99 is not None:
+        # Reconnections wait for the backoff, they are not handlers
+        worst = max(percentile(v, 0.99) for name, v in run.latencies.items()
+                    if name != 'reconnect') * 1000
+        if worst > args.max_p99:
+            print('FAIL: p99 %.3fms above %.3fms' % (worst, args.max_p99))
+            sys.exit(1)
@@ -0,0 +1,96 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import logging
+from time import monotonic
+from urllib.parse import urlparse, parse_qs
+import youtube_dl
+
+
+log = logging.getLogger(__name__)
+
+
+def video_id(url):
+    """
+    Youtube video id of a watch url, the url itself if there is none
+    """
+    ids = parse_qs(urlparse(url).query).get('v')
+    return ids[0] if ids else url
+
+
+class Resolver(object):
+
+    """
+    Resolve youtube urls into stream urls and metadata in a thread pool,
+    keeping the results for `ttl` seconds (stream urls end up expiring).
+    Concurrent resolutions of the same video share a single extraction.
+    """
+
+    YDL_OPTIONS = {
+        'format': 'webm[abr>0]/bestaudio/best',
+        'quiet': True,
+        'noplaylist': True,
+        'logger': log,
+    }
+
+    def __init__(self, ttl=3600, workers=4, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.ttl = ttl
+        self.executor = ThreadPoolExecutor(workers)
+        self._cache = dict()
+        self._pending = dict()
+        self.stats = {'hits': 0, 'misses': 0}
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+    def _extract(self, url):
+        ydl = youtube_dl.YoutubeDL(self.YDL_OPTIONS)
+        info = ydl.extract_info(url, download=False)
+        if 'entries' in info:
+            info = info['entries'][0]
+        return {
+            'id': info.get('id'),
+            'url': info['url'],
+            'title': info.get('title'),
+            'duration': info.get('duration'),
+        }
+
+    async def resolve(self, url):
+        key = video_id(url)
+        cached = self._cache.get(key)
+        if cached is not None and cached[0] > monotonic():
+            self.stats['hits'] += 1
+            return cached[1]
+
+        future = self._pending.get(key)
+        if future is not None:
+            self.stats['hits'] += 1
+            return await asyncio.shield(future)
+
+        self.stats['misses'] += 1
+        future = self.loop.run_in_executor(self.executor, self._extract, url)
+        self._pending[key] = future
+        try:
+            info = await asyncio.shield(future)
+        finally:
+            del self._pending[key]
+        self._cache[key] = (monotonic() + self.ttl, info)
+        self._expire()
+        return info
+
+    def prefetch(self, url):
+        """
+        Resolve in the background so that the next play is a cache hit
+        """
+        def done(future):
+            if not future.cancelled() and future.exception():
+                log.warning('Prefetch of %s failed: %s', url, future.exception())
+
+        log.debug('Prefetching %s', url)
+        asyncio.ensure_future(self.resolve(url), loop=self.loop).add_done_callback(done)
+
+    def _expire(self):
+        now = monotonic()
+        for key, (expires, _) in list(self._cache.items()):
+            if expires <= now:
+                del self._cache[key]
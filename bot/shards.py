@@ -0,0 +1,174 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import os
+from signal import signal, SIGINT, SIGTERM
+import subprocess
+import sys
+from time import sleep, time
+
+from storage import connect
+
+
+log = logging.getLogger(__name__)
+
+STATS_DIR = 'shards'
+
+
+def write_stats(shard_id, stats):
+    """
+    Publish a shard's counters for the other shards to aggregate
+    """
+    os.makedirs(STATS_DIR, exist_ok=True)
+    path = os.path.join(STATS_DIR, '%d.json' % shard_id)
+    stats = dict(stats, updated=int(time()))
+    with open(path + '.tmp', 'w') as f:
+        json.dump(stats, f)
+    os.replace(path + '.tmp', path)
+
+
+def read_stats(shard_count, max_age=120):
+    """
+    Counters of every shard which published them recently
+    """
+    shards = dict()
+    for shard_id in range(shard_count):
+        path = os.path.join(STATS_DIR, '%d.json' % shard_id)
+        try:
+            with open(path, 'r') as f:
+                stats = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if time() - stats['updated'] <= max_age:
+            shards[shard_id] = stats
+    return shards
+
+
+class Members(object):
+
+    """
+    Users seen by each shard, in a SQLite table shared by the shards: a
+    user on servers of several shards is counted by the lowest one only.
+    Published on the shard's own thread, from the full user set, whose
+    changes since the previous publish are written.
+    """
+
+    def __init__(self, shard_id, path=os.path.join(STATS_DIR, 'members.sqlite3'),
+                 loop=None):
+        self.shard_id = shard_id
+        self.path = path
+        self.loop = loop or asyncio.get_event_loop()
+        self.executor = ThreadPoolExecutor(1)
+        # Read from the loop thread, written from the executor's
+        self.reader = None
+        self.writer = None
+        # User ids last written, only used by the executor's thread
+        self._published = None
+
+    async def open(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        await self.loop.run_in_executor(self.executor, self._open)
+        self.reader = connect(self.path)
+
+    def _open(self):
+        self.writer = connect(self.path, check_same_thread=False)
+        self.writer.execute(
+            'CREATE TABLE IF NOT EXISTS members (user_id TEXT, shard_id INTEGER, '
+            'PRIMARY KEY (user_id, shard_id)) WITHOUT ROWID')
+
+    async def publish(self, users):
+        await self.loop.run_in_executor(self.executor, self._publish, set(users))
+
+    def _publish(self, users):
+        self.writer.execute('BEGIN IMMEDIATE')
+        try:
+            if self._published is None:
+                # Whatever a previous run of this shard left
+                self.writer.execute(
+                    'DELETE FROM members WHERE shard_id = ?', (self.shard_id,))
+                added, removed = users, ()
+            else:
+                added, removed = users - self._published, self._published - users
+            self.writer.executemany(
+                'DELETE FROM members WHERE user_id = ? AND shard_id = ?',
+                [(user_id, self.shard_id) for user_id in removed])
+            self.writer.executemany(
+                'INSERT OR IGNORE INTO members (user_id, shard_id) VALUES (?, ?)',
+                [(user_id, self.shard_id) for user_id in added])
+        except Exception:
+            self.writer.execute('ROLLBACK')
+            raise
+        self.writer.execute('COMMIT')
+        self._published = users
+
+    def owns(self, user_id):
+        """
+        Whether this shard counts the user, unknown users included
+        """
+        row = self.reader.execute(
+            'SELECT min(shard_id) FROM members WHERE user_id = ?', (user_id,)).fetchone()
+        return row[0] is None or row[0] >= self.shard_id
+
+    async def unique(self):
+        """
+        Number of users across every shard
+        """
+        return await self.loop.run_in_executor(self.executor, self._unique)
+
+    def _unique(self):
+        return self.writer.execute(
+            'SELECT count(DISTINCT user_id) FROM members').fetchone()[0]
+
+    async def close(self):
+        """
+        Leave this shard's users to the other shards
+        """
+        self.reader.close()
+        await self.loop.run_in_executor(self.executor, self._close)
+        self.executor.shutdown()
+
+    def _close(self):
+        self.writer.execute('DELETE FROM members WHERE shard_id = ?', (self.shard_id,))
+        self.writer.close()
+
+
+def supervise(shard_count, argv, restart_delay=5):
+    """
+    Run one bot process per shard, restarting the ones which die,
+    until SIGINT/SIGTERM which is forwarded to every worker
+    """
+    workers = dict()
+    stopping = []
+
+    def spawn(shard_id):
+        cmd = [sys.executable, os.path.abspath(sys.argv[0]),
+               '--shard-id', str(shard_id), '--shard-count', str(shard_count)]
+        workers[shard_id] = subprocess.Popen(cmd + argv)
+        log.info('Shard %d started, pid %d', shard_id, workers[shard_id].pid)
+
+    def stop(signum, frame):
+        log.info('Stopping %d shards', len(workers))
+        stopping.append(signum)
+        for worker in workers.values():
+            worker.send_signal(signum)
+
+    signal(SIGINT, stop)
+    signal(SIGTERM, stop)
+
+    for shard_id in range(shard_count):
+        spawn(shard_id)
+
+    while workers:
+        sleep(1)
+        for shard_id, worker in list(workers.items()):
+            code = worker.poll()
+            if code is None:
+                continue
+            del workers[shard_id]
+            if stopping:
+                continue
+            log.error('Shard %d exited with %d, restarting it', shard_id, code)
+            sleep(restart_delay)
+            spawn(shard_id)
+    log.info('Every shard stopped')
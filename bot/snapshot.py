@@ -0,0 +1,168 @@
+"""
+Compact binary snapshots of in-flight state, to restart without losing it.
+
+sessions:   header, game names, then (user_id, game index, start) records
+
+The header holds a magic, a format version, the snapshot time and the
+number of records. Files are written under a temporary name and renamed.
+
+Sessions change all the time, so they also have a journal next to the
+snapshot (<path>.journal), appended with the changes since the previous
+save: batches of (saved_at, count) then (kind, user_id, start, game)
+records, a session starting or ending. Writing a full snapshot removes
+the journal.
+"""
+import logging
+import os
+import struct
+
+
+log = logging.getLogger(__name__)
+
+VERSION = 1
+HEADER = struct.Struct('<4sHdI')
+NAME_LENGTH = struct.Struct('<H')
+SESSION = struct.Struct('<QId')
+BATCH = struct.Struct('<dI')
+CHANGE = struct.Struct('<BQdH')
+
+STARTED, ENDED = 1, 0
+
+
+def _write(path, data):
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(path + '.tmp', path)
+
+
+def _read(path, magic):
+    """
+    Return (saved_at, count, data, offset), None if there is no usable file
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    try:
+        file_magic, version, saved_at, count = HEADER.unpack_from(data)
+    except struct.error:
+        log.error('Truncated snapshot %s', path)
+        return None
+    if file_magic != magic or version != VERSION:
+        log.error('Unknown snapshot format in %s', path)
+        return None
+    return saved_at, count, data, HEADER.size
+
+
+def save_sessions(path, saved_at, sessions):
+    """
+    `sessions` being {user_id: (game, start unix time)}. Return the size
+    of the snapshot.
+    """
+    games = dict()
+    records = []
+    for user_id, (game, start) in sessions.items():
+        index = games.setdefault(game, len(games))
+        records.append(SESSION.pack(int(user_id), index, start))
+
+    parts = [HEADER.pack(b'SESS', VERSION, saved_at, len(records)),
+             NAME_LENGTH.pack(len(games))]
+    for game in sorted(games, key=games.get):
+        name = game.encode()
+        parts.append(NAME_LENGTH.pack(len(name)))
+        parts.append(name)
+    parts.extend(records)
+    data = b''.join(parts)
+    _write(path, data)
+    # Older than the snapshot, it would be skipped anyway
+    try:
+        os.remove(path + '.journal')
+    except FileNotFoundError:
+        pass
+    return len(data)
+
+
+def append_sessions(path, saved_at, changes):
+    """
+    Append the changes since the last save to the journal, `changes`
+    being {user_id: (game, start unix time), or None for an ended
+    session}. Return the size of the journal.
+    """
+    parts = [BATCH.pack(saved_at, len(changes))]
+    for user_id, session in changes.items():
+        if session is None:
+            parts.append(CHANGE.pack(ENDED, int(user_id), 0, 0))
+        else:
+            game, start = session
+            name = game.encode()
+            parts.append(CHANGE.pack(STARTED, int(user_id), start, len(name)))
+            parts.append(name)
+    with open(path + '.journal', 'ab') as f:
+        f.write(b''.join(parts))
+        return f.tell()
+
+
+def _replay_journal(path, since, sessions):
+    """
+    Apply the journal's batches saved after `since` to `sessions`, return
+    the time of the last one. An incomplete last batch is ignored.
+    """
+    try:
+        with open(path + '.journal', 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return since
+    offset = 0
+    try:
+        while offset < len(data):
+            saved_at, count = BATCH.unpack_from(data, offset)
+            offset += BATCH.size
+            changes = []
+            for _ in range(count):
+                kind, user_id, start, length = CHANGE.unpack_from(data, offset)
+                offset += CHANGE.size
+                if offset + length > len(data):
+                    raise struct.error('truncated game name')
+                game = data[offset:offset + length].decode()
+                offset += length
+                changes.append((kind, str(user_id), game, start))
+            if since is not None and saved_at <= since:
+                continue
+            for kind, user_id, game, start in changes:
+                if kind == STARTED:
+                    sessions[user_id] = (game, start)
+                else:
+                    sessions.pop(user_id, None)
+            since = saved_at
+    except struct.error:
+        log.error('Truncated journal %s.journal, ignoring its end', path)
+    return since
+
+
+def load_sessions(path):
+    """
+    Return (saved_at, {user_id: (game, start unix time)}) with the journal
+    applied, (None, {}) if there is no snapshot
+    """
+    snapshot = _read(path, b'SESS')
+    if snapshot is None:
+        return None, {}
+    saved_at, count, data, offset = snapshot
+
+    games = []
+    (game_count,) = NAME_LENGTH.unpack_from(data, offset)
+    offset += NAME_LENGTH.size
+    for _ in range(game_count):
+        (length,) = NAME_LENGTH.unpack_from(data, offset)
+        offset += NAME_LENGTH.size
+        games.append(data[offset:offset + length].decode())
+        offset += length
+
+    sessions = dict()
+    for user_id, index, start in SESSION.iter_unpack(
+            data[offset:offset + count * SESSION.size]):
+        sessions[str(user_id)] = (games[index], start)
+    saved_at = _replay_journal(path, saved_at, sessions)
+    return saved_at, sessions
+
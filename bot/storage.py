@@ -0,0 +1,529 @@
+#!/usr/bin/env python
+from abc import ABCMeta, abstractmethod
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import json
+import logging
+import os
+import sqlite3
+import threading
+from time import monotonic
+import yolodb
+
+from metrics import Histogram
+
+
+log = logging.getLogger(__name__)
+
+MISSING = object()
+
+
+def connect(path, **kwargs):
+    """
+    SQLite connection in WAL mode, transactions being explicit and
+    waiting on other processes' ones
+    """
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None, **kwargs)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
+class Store(metaclass=ABCMeta):
+
+    """
+    What the modules see of their database: a mapping of string keys to
+    JSON values, persisted by the backend.
+    Mutated values must be assigned back to be saved.
+    """
+
+    def get(self, key, default=None):
+        return self.all.get(key, default)
+
+    def __getitem__(self, key):
+        return self.all[key]
+
+    def __contains__(self, key):
+        return key in self.all
+
+    def __len__(self):
+        return len(self.all)
+
+    @property
+    @abstractmethod
+    def all(self):
+        pass
+
+    @abstractmethod
+    def __setitem__(self, key, value):
+        pass
+
+    @abstractmethod
+    def pop(self, key, default=None):
+        pass
+
+    def incr(self, key, field, amount):
+        """
+        Add `amount` to the `field` of the dict at `key`
+        """
+        value = self.get(key, {})
+        value[field] = value.get(field, 0) + amount
+        self[key] = value
+
+    @contextmanager
+    def batch(self):
+        """
+        Group the writes done within into a single transaction
+        """
+        yield
+
+    @abstractmethod
+    async def close(self):
+        pass
+
+
+class YoloStore(Store):
+
+    """
+    Plain yolodb, the whole file being rewritten at most every 2 seconds
+    after a change, on a thread. Its `all` is a copy of the whole db.
+    The writes of a batch are kept aside and applied together at its end,
+    a save never catching a batch half written.
+    """
+
+    MISSING = MISSING
+
+    def __init__(self, db):
+        self.db = db
+        # Writes deferred by a batch, MISSING for a popped key
+        self._pending = dict()
+        self._batching = 0
+
+    @classmethod
+    async def open(cls, path, loop=None):
+        return cls(await yolodb.load(path, loop=loop))
+
+    @property
+    def all(self):
+        data = self.db.all
+        for key, value in self._pending.items():
+            if value is self.MISSING:
+                data.pop(key, None)
+            else:
+                data[key] = value
+        return data
+
+    def get(self, key, default=None):
+        value = self._pending.get(key, self.MISSING)
+        if value is self.MISSING:
+            if key in self._pending:
+                return default
+            return self.db.get(key, default)
+        return value
+
+    def __getitem__(self, key):
+        value = self.get(key, self.MISSING)
+        if value is self.MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, self.MISSING) is not self.MISSING
+
+    def __setitem__(self, key, value):
+        if self._batching:
+            self._pending[key] = value
+        else:
+            self.db[key] = value
+
+    def pop(self, key, default=None):
+        value = self.get(key, self.MISSING)
+        if value is self.MISSING:
+            return default
+        if self._batching:
+            self._pending[key] = self.MISSING
+        else:
+            self.db.pop(key)
+        return value
+
+    @contextmanager
+    def batch(self):
+        self._batching += 1
+        try:
+            yield
+        finally:
+            self._batching -= 1
+            if not self._batching:
+                self._apply()
+
+    def _apply(self):
+        for key, value in self._pending.items():
+            if value is self.MISSING:
+                self.db.pop(key, None)
+            else:
+                self.db[key] = value
+        self._pending.clear()
+
+    async def close(self):
+        self._apply()
+        await self.db.close()
+
+
+class Layer(object):
+
+    """
+    Writes of a SqliteStore not committed yet: {key: value, MISSING once
+    popped} and {key: {field: increment}}, never both for the same key
+    """
+
+    __slots__ = ('id', 'values', 'increments')
+
+    def __init__(self, id):
+        self.id = id
+        self.values = dict()
+        self.increments = dict()
+
+    def __bool__(self):
+        return bool(self.values or self.increments)
+
+    def apply(self, key, value):
+        """
+        `value` as this layer leaves it
+        """
+        if key in self.values:
+            return self.values[key]
+        increments = self.increments.get(key)
+        if increments:
+            value = dict(value) if isinstance(value, dict) else {}
+            for field, amount in increments.items():
+                value[field] = value.get(field, 0) + amount
+        return value
+
+
+def _dump(value):
+    # Numbers are kept as such, for incr to add to them
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+    return json.dumps(value)
+
+
+def _load(value):
+    return json.loads(value) if isinstance(value, str) else value
+
+
+class SqliteStore(Store):
+
+    """
+    SQLite in WAL mode, shared by every process using the same file: keys
+    are read on demand and written row by row, dict values one row per
+    field so that `incr` only adds to that field.
+    Writes are kept in memory `delay` seconds (or until the end of a
+    batch) and reads see them meanwhile, then they are written in a
+    single transaction on a dedicated thread. Other processes' writes
+    are seen once committed. `all` reads the whole db.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path, delay=0.1, loop=None):
+        self.path = path
+        self.delay = delay
+        self.loop = loop or asyncio.get_event_loop()
+        self.executor = ThreadPoolExecutor(1)
+        # Read from the loop thread, written from the executor's
+        self.reader = None
+        self.writer = None
+
+        # Uncommitted writes, oldest first, new ones going to the last one
+        self._layers = [Layer(1)]
+        # Last layer committed, reads skip it and the older ones. Set
+        # along with the commit, under the lock reads take
+        self._committed = 0
+        self._lock = threading.Lock()
+        self._batching = 0
+        self._timer = None
+        self._writes = set()
+
+        self.stats = {'transactions': 0, 'rows': 0}
+        self.latency = Histogram()
+
+    @classmethod
+    async def open(cls, path, loop=None):
+        store = cls(path, loop=loop)
+        await store.loop.run_in_executor(store.executor, store._open)
+        store.reader = connect(path)
+        return store
+
+    def _open(self):
+        self.writer = connect(self.path, check_same_thread=False)
+        self.writer.execute('BEGIN IMMEDIATE')
+        try:
+            version = self.writer.execute('PRAGMA user_version').fetchone()[0]
+            if version < self.VERSION:
+                self._migrate()
+                self.writer.execute('PRAGMA user_version = %d' % self.VERSION)
+        except Exception:
+            self.writer.execute('ROLLBACK')
+            raise
+        self.writer.execute('COMMIT')
+
+    def _migrate(self):
+        """
+        From the first layout, one row per key with its whole JSON value
+        """
+        self.writer.execute(
+            'CREATE TABLE IF NOT EXISTS data (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        self.writer.execute('ALTER TABLE data RENAME TO data_v0')
+        # A NULL value stands for a dict, its fields being in `fields`
+        self.writer.execute('CREATE TABLE data (key TEXT PRIMARY KEY, value TEXT)')
+        self.writer.execute(
+            'CREATE TABLE fields (key TEXT, field TEXT, value, PRIMARY KEY (key, field))')
+        for key, value in self.writer.execute('SELECT key, value FROM data_v0'):
+            self._write_value(key, json.loads(value))
+        self.writer.execute('DROP TABLE data_v0')
+
+    def _write_value(self, key, value):
+        self.writer.execute('DELETE FROM fields WHERE key = ?', (key,))
+        if isinstance(value, dict):
+            self.writer.execute(
+                'INSERT OR REPLACE INTO data (key, value) VALUES (?, NULL)', (key,))
+            self.writer.executemany(
+                'INSERT INTO fields (key, field, value) VALUES (?, ?, ?)',
+                [(key, field, _dump(v)) for field, v in value.items()])
+        else:
+            self.writer.execute(
+                'INSERT OR REPLACE INTO data (key, value) VALUES (?, ?)',
+                (key, json.dumps(value)))
+
+    @contextmanager
+    def _snapshot(self):
+        """
+        Read transaction, along with the last layer it includes
+        """
+        with self._lock:
+            self.reader.execute('BEGIN')
+            try:
+                yield self._committed
+            finally:
+                self.reader.execute('COMMIT')
+
+    def _select(self, key):
+        row = self.reader.execute(
+            'SELECT value FROM data WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return MISSING
+        if row[0] is not None:
+            return json.loads(row[0])
+        return dict(
+            (field, _load(value)) for field, value in self.reader.execute(
+                'SELECT field, value FROM fields WHERE key = ?', (key,)))
+
+    def _read(self, key):
+        with self._snapshot() as committed:
+            value = self._select(key)
+        for layer in self._layers:
+            if layer.id > committed:
+                value = layer.apply(key, value)
+        return value
+
+    def get(self, key, default=None):
+        value = self._read(key)
+        return default if value is MISSING else value
+
+    def __getitem__(self, key):
+        value = self._read(key)
+        if value is MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self._read(key) is not MISSING
+
+    @property
+    def all(self):
+        with self._snapshot() as committed:
+            data = dict(
+                (key, MISSING if value is None else json.loads(value))
+                for key, value in self.reader.execute('SELECT key, value FROM data'))
+            for key, field, value in self.reader.execute(
+                    'SELECT key, field, value FROM fields'):
+                if data.get(key) is MISSING:
+                    data[key] = dict()
+                data[key][field] = _load(value)
+        for key, value in data.items():
+            if value is MISSING:
+                data[key] = dict()
+        for layer in self._layers:
+            if layer.id <= committed:
+                continue
+            for key in set(layer.values) | set(layer.increments):
+                value = layer.apply(key, data.get(key, MISSING))
+                if value is MISSING:
+                    data.pop(key, None)
+                else:
+                    data[key] = value
+        return data
+
+    def __setitem__(self, key, value):
+        layer = self._layers[-1]
+        layer.increments.pop(key, None)
+        layer.values[key] = value
+        self._changed()
+
+    def pop(self, key, default=None):
+        value = self._read(key)
+        if value is MISSING:
+            return default
+        layer = self._layers[-1]
+        layer.increments.pop(key, None)
+        layer.values[key] = MISSING
+        self._changed()
+        return value
+
+    def incr(self, key, field, amount):
+        layer = self._layers[-1]
+        if key in layer.values:
+            value = layer.values[key]
+            value = dict(value) if isinstance(value, dict) else {}
+            value[field] = value.get(field, 0) + amount
+            layer.values[key] = value
+        else:
+            increments = layer.increments.setdefault(key, {})
+            increments[field] = increments.get(field, 0) + amount
+        self._changed()
+
+    @contextmanager
+    def batch(self):
+        self._batching += 1
+        try:
+            yield
+        finally:
+            self._batching -= 1
+            if not self._batching:
+                self.flush()
+
+    def _changed(self):
+        if not self._batching and self._timer is None:
+            self._timer = self.loop.call_later(self.delay, self.flush)
+
+    def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        layer = self._layers[-1]
+        if not layer:
+            return
+        self._layers.append(Layer(layer.id + 1))
+        # Serialized here, the values may be changed once given back
+        values = [(key, value if value is MISSING else json.loads(json.dumps(value)))
+                  for key, value in layer.values.items()]
+        increments = [(key, field, amount)
+                      for key, fields in layer.increments.items()
+                      for field, amount in fields.items()]
+        future = self.loop.run_in_executor(
+            self.executor, self._write, layer.id, values, increments)
+        self._writes.add(future)
+        future.add_done_callback(lambda future: self._written(future, layer))
+
+    def _write(self, layer_id, values, increments):
+        start = monotonic()
+        self.writer.execute('BEGIN IMMEDIATE')
+        try:
+            for key, value in values:
+                if value is MISSING:
+                    self.writer.execute('DELETE FROM data WHERE key = ?', (key,))
+                    self.writer.execute('DELETE FROM fields WHERE key = ?', (key,))
+                else:
+                    self._write_value(key, value)
+            keys = set((key,) for key, _, _ in increments)
+            self.writer.executemany(
+                'INSERT OR IGNORE INTO data (key, value) VALUES (?, NULL)', keys)
+            self.writer.executemany(
+                'INSERT OR IGNORE INTO fields (key, field, value) VALUES (?, ?, 0)',
+                [(key, field) for key, field, _ in increments])
+            self.writer.executemany(
+                'UPDATE fields SET value = value + ? WHERE key = ? AND field = ?',
+                [(amount, key, field) for key, field, amount in increments])
+        except Exception:
+            self.writer.execute('ROLLBACK')
+            raise
+        with self._lock:
+            self.writer.execute('COMMIT')
+            self._committed = layer_id
+        return len(values) + len(increments), monotonic() - start
+
+    def _written(self, future, layer):
+        self._writes.discard(future)
+        self._layers.remove(layer)
+        if future.cancelled():
+            return
+        if future.exception():
+            log.error('Write to %s failed: %s', self.path, future.exception())
+            return
+        rows, latency = future.result()
+        self.stats['transactions'] += 1
+        self.stats['rows'] += rows
+        self.latency.observe(latency)
+
+    async def close(self):
+        self.flush()
+        if self._writes:
+            await asyncio.wait(list(self._writes))
+        self.reader.close()
+        await self.loop.run_in_executor(self.executor, self.writer.close)
+        self.executor.shutdown()
+
+
+BACKENDS = {
+    'yolodb': ('.db', YoloStore),
+    'sqlite': ('.sqlite3', SqliteStore),
+}
+
+
+def store_path(path, backend='yolodb'):
+    """
+    File of `path` (a yolodb file name) for the given backend, other
+    backends use the same name with their own extension
+    """
+    return os.path.splitext(path)[0] + BACKENDS[backend][0]
+
+
+async def open_store(path, backend='yolodb', loop=None):
+    """
+    Open `path` (a yolodb file name) with the given backend
+    """
+    path = store_path(path, backend)
+    log.info('Opening %s with %s', path, backend)
+    return await BACKENDS[backend][1].open(path, loop=loop)
+
+
+async def migrate(paths, backend='sqlite', loop=None):
+    """
+    Copy yolodb files into the given backend
+    """
+    for path in paths:
+        source = await YoloStore.open(path, loop=loop)
+        target = await open_store(path, backend, loop=loop)
+        with target.batch():
+            for key, value in source.all.items():
+                target[key] = value
+        log.info('Migrated %d keys from %s', len(source), path)
+        await target.close()
+        await source.close()
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='Migrate yolodb files to another backend')
+    parser.add_argument('paths', nargs='+', help='yolodb files, e.g. gametime.db')
+    parser.add_argument(
+        '-b', '--backend', default='sqlite',
+        choices=[b for b in sorted(BACKENDS) if b != 'yolodb'])
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(migrate(args.paths, args.backend, loop=loop))
+    loop.close()